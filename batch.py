@@ -0,0 +1,346 @@
+'''Run many copies of one program in lockstep.
+
+A BatchMachine holds N copies ("lanes") of a process's memory and
+registers as NumPy arrays.  Each step executes one instruction for every
+running lane: lanes that are at the same pc execute it together, as array
+operations.  Lanes only split up where a conditional jump goes different
+ways for different lanes, so a sweep over thousands of inputs costs
+about as much Python work as a single run.
+
+Differences from CPU:
+o Memory holds integers only (int64, so values wrap around instead of
+  growing without bound).  Instructions are taken from RAM once, when
+  the BatchMachine is created: programs must not modify their own code.
+  Reading a word that holds an instruction or a string gives 0.
+o An out-of-range address stops the lane with ILLEGAL_ADDRESS instead
+  of just printing a warning.
+o pc cannot be used as an operand: an instruction that does is illegal.
+o There are no system calls and no timer: "call <fname>" stops the lane
+  with ILLEGAL_INSTRUCTION.  (call <addr> and call <reg> are subroutine
+  calls, as on CPU.)
+'''
+
+import numpy as np
+
+import cpu as cpumodule
+from ram import PAGE_SIZE
+
+# Lane status: RUNNING, or the trap reason the lane stopped with.
+RUNNING = -1
+
+REGISTER_NAMES = ('reg0', 'reg1', 'reg2', 'flags', 'sp')
+FLAGS = REGISTER_NAMES.index('flags')
+SP = REGISTER_NAMES.index('sp')
+
+# Operand kinds.  The value of an IND operand is (register, offset).
+REG, LIT, MEM, IND = "REG", "LIT", "MEM", "IND"
+
+
+class BatchMachine:
+
+    def __init__(self, ram, pcb, num_lanes):
+        '''Make num_lanes copies of the process described by pcb, whose
+        memory is in ram from pcb.get_low_mem() to pcb.get_high_mem()
+        (apart from its code, if it is in a text segment).
+        All lanes start at the pcb's entry point with registers zeroed,
+        except sp, which starts at the top of memory (an empty stack).
+        The stack may grow down to pcb's stack base, as on CPU.'''
+        words = read_process_words(ram, pcb)
+        self._size = len(words)
+        self._stack_base = max(pcb.get_stack_base(), 0)
+        self._num_lanes = num_lanes
+
+        # Decoded instructions, by logical address.
+        self._code = {}
+        image = np.zeros(self._size, dtype=np.int64)
+        for addr, val in enumerate(words):
+            if isinstance(val, int):
+                image[addr] = val
+            else:
+                self._code[addr] = _decode(val)
+
+        self._memory = np.tile(image, (num_lanes, 1))
+        self._registers = np.zeros((len(REGISTER_NAMES), num_lanes), dtype=np.int64)
+        self._registers[SP] = self._size
+        self._pc = np.full(num_lanes, pcb.get_entry_point(), dtype=np.int64)
+        self._status = np.full(num_lanes, RUNNING, dtype=np.int64)
+
+    def get_num_lanes(self):
+        return self._num_lanes
+
+    def set_word(self, addr, vals):
+        '''Store vals at logical address addr: either one value for all
+        lanes or a sequence with one value per lane.'''
+        self._memory[:, addr] = vals
+
+    def get_word(self, addr):
+        '''Return an array holding the word at addr, for each lane.'''
+        return self._memory[:, addr].copy()
+
+    def get_words(self, addr, count):
+        '''Return an array of shape (lanes, count) holding the words
+        from addr to addr + count - 1.'''
+        return self._memory[:, addr:addr + count].copy()
+
+    def get_registers(self):
+        '''Return a dictionary mapping register name (and 'pc') to an
+        array of that register's value in each lane.'''
+        regs = {name: self._registers[idx].copy()
+                for idx, name in enumerate(REGISTER_NAMES)}
+        regs['pc'] = self._pc.copy()
+        return regs
+
+    def get_status(self):
+        '''Return an array holding RUNNING or the trap reason, per lane.'''
+        return self._status.copy()
+
+    def run(self, max_steps=None):
+        '''Step until all lanes have stopped, or max_steps steps have
+        been taken.  Return the number of steps taken.'''
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            if not self.step():
+                break
+            steps += 1
+        return steps
+
+    def step(self):
+        '''Execute one instruction in every running lane.  Return False
+        if no lanes were running.'''
+        running = self._status == RUNNING
+        if not running.any():
+            return False
+        # Group the lanes by pc before executing anything, so that a lane
+        # that jumps to a pc that is executed later in this step does not
+        # execute twice.
+        pcs = self._pc.copy()
+        for pc in np.unique(pcs[running]):
+            lanes = np.nonzero(running & (pcs == pc))[0]
+            instr = self._code.get(int(pc))
+            if instr is None:
+                self._trap(lanes, cpumodule.ILLEGAL_INSTRUCTION)
+            else:
+                self._execute(instr, lanes)
+        return True
+
+    def _execute(self, instr, lanes):
+        op, src, dst = instr
+        if op == 'mov':
+            keep, srcval = self._read(src, lanes)
+            lanes = self._write(dst, lanes[keep], srcval)
+            self._pc[lanes] += 1
+        elif op in _ARITHMETIC:
+            keep, srcval = self._read(src, lanes)
+            lanes = lanes[keep]
+            keep, currval = self._read(dst, lanes)
+            lanes, srcval = lanes[keep], srcval[keep]
+            if op == 'div' or op == 'mod':
+                zero = srcval == 0
+                if zero.any():
+                    self._trap(lanes[zero], cpumodule.DIVIDE_BY_ZERO)
+                    lanes, srcval, currval = lanes[~zero], srcval[~zero], currval[~zero]
+            result = _ARITHMETIC[op](currval, srcval)
+            if op == 'cmp':
+                self._registers[FLAGS, lanes] = result
+            else:
+                lanes = self._write(dst, lanes, result)
+            self._pc[lanes] += 1
+        elif op in _CONDITIONS:
+            # Jump operands are registers or literals: always legal.
+            srcval = self._read(src, lanes)[1]
+            target = self._read(dst, lanes)[1]
+            taken = _CONDITIONS[op](srcval)
+            self._pc[lanes] = np.where(taken, target, self._pc[lanes] + 1)
+        elif op == 'jmp':
+            self._pc[lanes] = self._read(dst, lanes)[1]
+        elif op == 'push':
+            keep, srcval = self._read(src, lanes)
+            lanes = self._push(lanes[keep], srcval)
+            self._pc[lanes] += 1
+        elif op == 'pop':
+            lanes, vals = self._pop(lanes)
+            lanes = self._write(dst, lanes, vals)
+            self._pc[lanes] += 1
+        elif op == 'call':
+            target = self._read(dst, lanes)[1]
+            keep = np.isin(lanes, self._push(lanes, self._pc[lanes] + 1))
+            self._pc[lanes[keep]] = target[keep]
+        elif op == 'ret':
+            lanes, vals = self._pop(lanes)
+            self._pc[lanes] = vals
+        elif op == 'end':
+            self._trap(lanes, cpumodule.END_OF_PROGRAM)
+        else:
+            self._trap(lanes, cpumodule.ILLEGAL_INSTRUCTION)
+
+    def _read(self, operand, lanes):
+        '''Return (keep, vals): keep is a boolean mask selecting the given
+        lanes in which operand's address is legal, and vals holds the
+        operand's value in each of those lanes.  The other lanes are
+        stopped.'''
+        kind, val = operand
+        if kind == REG:
+            return np.ones(len(lanes), dtype=bool), self._registers[val, lanes]
+        if kind == LIT:
+            return np.ones(len(lanes), dtype=bool), np.full(len(lanes), val, dtype=np.int64)
+        keep, addrs = self._addresses(operand, lanes)
+        return keep, self._memory[lanes[keep], addrs]
+
+    def _write(self, operand, lanes, vals):
+        '''Store vals into operand, in each of the given lanes.  Return
+        the lanes in which operand's address is legal: the other lanes
+        are stopped.'''
+        kind, val = operand
+        if kind == REG:
+            self._registers[val, lanes] = vals
+            return lanes
+        keep, addrs = self._addresses(operand, lanes)
+        lanes = lanes[keep]
+        self._memory[lanes, addrs] = vals[keep]
+        return lanes
+
+    def _addresses(self, operand, lanes):
+        '''Return (keep, addrs) for a memory operand: a boolean mask
+        selecting the given lanes whose address is legal, and those
+        addresses.  Lanes with an illegal address are stopped.'''
+        kind, val = operand
+        if kind == MEM:
+            addrs = np.full(len(lanes), val, dtype=np.int64)
+        else:
+            reg, offset = val
+            addrs = self._registers[reg, lanes] + offset
+        keep = (addrs >= 0) & (addrs < self._size)
+        if not keep.all():
+            self._trap(lanes[~keep], cpumodule.ILLEGAL_ADDRESS)
+        return keep, addrs[keep]
+
+    def _push(self, lanes, vals):
+        '''Push vals onto the stack in each of the given lanes.  Return
+        the lanes whose stack was not full: the others are stopped.  (sp
+        is a register like any other, so it may point anywhere.)'''
+        sp = self._registers[SP, lanes] - 1
+        keep = (sp >= self._stack_base) & (sp < self._size)
+        if not keep.all():
+            self._trap(lanes[~keep], cpumodule.ILLEGAL_ADDRESS)
+        lanes, sp = lanes[keep], sp[keep]
+        self._memory[lanes, sp] = vals[keep]
+        self._registers[SP, lanes] = sp
+        return lanes
+
+    def _pop(self, lanes):
+        '''Pop the stack in each of the given lanes.  Return (lanes, vals):
+        the lanes whose stack was not empty -- the others are stopped --
+        and the values popped in them.'''
+        sp = self._registers[SP, lanes]
+        keep = (sp >= 0) & (sp < self._size)
+        if not keep.all():
+            self._trap(lanes[~keep], cpumodule.ILLEGAL_ADDRESS)
+        lanes, sp = lanes[keep], sp[keep]
+        self._registers[SP, lanes] = sp + 1
+        return lanes, self._memory[lanes, sp]
+
+    def _trap(self, lanes, reason):
+        '''Stop the given lanes.  Like CPU, leave the reason in reg0.'''
+        # Lanes that already stopped (e.g., with a bad address while
+        # reading an operand) keep their first reason.
+        lanes = lanes[self._status[lanes] == RUNNING]
+        self._status[lanes] = reason
+        self._registers[0, lanes] = reason
+
+
+def read_process_words(ram, pcb):
+    '''Return the list of words of the process described by pcb, by
+    logical address, from 0 up to its memory limit.'''
+    low = pcb.get_low_mem()
+    size = pcb.get_high_mem() - low
+    seg = pcb.get_text()
+    if seg is None:
+        words = ram.read_block(low, size)
+    else:
+        # The code is in the process's shared text segment.
+        words = (ram.read_block(seg.get_start(), seg.get_size()) +
+                 ram.read_block(low + seg.get_size(), size - seg.get_size()))
+    if pcb.get_page_table() is not None:
+        # Pages of a demand-paged process that are not present yet
+        # come from its tape.
+        tape_words = pcb.get_demand_image()
+        for page, present in enumerate(pcb.get_page_table()):
+            start = page * PAGE_SIZE
+            chunk = tape_words[start:start + PAGE_SIZE]
+            if not present and chunk:
+                words[start:start + len(chunk)] = chunk
+    return words
+
+
+# dst = func(dst, src).  cmp sets the flags register instead of dst.
+_ARITHMETIC = {
+    'add': np.add,
+    'sub': np.subtract,
+    'mul': np.multiply,
+    'div': np.floor_divide,
+    'mod': np.mod,
+    # Not np.sign(dst - src): the difference can overflow.
+    'cmp': lambda dst, src: (dst > src).astype(np.int64) - (dst < src),
+}
+
+_CONDITIONS = {
+    'jez': lambda vals: vals == 0,
+    'jnz': lambda vals: vals != 0,
+    'jgz': lambda vals: vals > 0,
+    'jlz': lambda vals: vals < 0,
+}
+
+
+def _decode(instr):
+    '''Decode an instruction string into (op, src, dst), where src and
+    dst are (kind, value) operands, or None if there is no such operand.
+    Anything that cannot be decoded becomes an illegal instruction.'''
+    words = instr.replace(",", "").split()
+    if len(words) == 0:
+        return ('illegal', None, None)
+    op = words[0]
+    try:
+        if (op == 'end' or op == 'ret') and len(words) == 1:
+            return (op, None, None)
+        if op == 'push' and len(words) == 2:
+            return (op, _decode_operand(words[1]), None)
+        if op == 'pop' and len(words) == 2:
+            dst = _decode_operand(words[1])
+            if dst[0] == LIT:
+                dst = (MEM, dst[1])
+            return (op, None, dst)
+        if (op == 'jmp' or op == 'call') and len(words) == 2:
+            dst = _decode_operand(words[1])
+            if dst[0] not in (REG, LIT):
+                return ('illegal', None, None)
+            return (op, None, dst)
+        if (op == 'mov' or op in _ARITHMETIC) and len(words) == 3:
+            dst = _decode_operand(words[2])
+            if dst[0] == LIT:
+                # A literal destination is a memory address.
+                dst = (MEM, dst[1])
+            return (op, _decode_operand(words[1]), dst)
+        if op in _CONDITIONS and len(words) == 3:
+            src = _decode_operand(words[1])
+            dst = _decode_operand(words[2])
+            if src[0] != REG or dst[0] not in (REG, LIT):
+                return ('illegal', None, None)
+            return (op, src, dst)
+    except ValueError:
+        pass
+    return ('illegal', None, None)
+
+
+def _decode_operand(s):
+    if s in REGISTER_NAMES:
+        return (REG, REGISTER_NAMES.index(s))
+    if s[0] == '*':
+        ref = s[1:]
+        if ref in REGISTER_NAMES:
+            return (IND, (REGISTER_NAMES.index(ref), 0))
+        for sign in '+-':
+            reg, _, offset = ref.partition(sign)
+            if reg in REGISTER_NAMES and offset != '':
+                return (IND, (REGISTER_NAMES.index(reg), int(sign + offset, 0)))
+        return (MEM, int(ref, 0))
+    return (LIT, int(s, 0))
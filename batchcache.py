@@ -0,0 +1,212 @@
+'''Cache the results of batch runs on disk.
+
+Many batch jobs are exact repeats: the same program, the same input
+words and the same settings.  run_batch() runs a BatchMachine, but first
+looks the run up in a ResultCache, by a hash of
+o the process's memory image (code and data, as the BatchMachine would
+  load it), its entry point and its stack base,
+o the input words poked into each lane, and where they go,
+o the number of lanes, max_steps and the output ranges asked for.
+A repeat run returns the stored output words, status and registers
+without executing anything.
+
+The cache is a directory with one file per result.  When the files add
+up to more than max_bytes, the least recently used ones are deleted.
+Several processes can share a cache directory: files are written under
+a temporary name and renamed into place, and a file that cannot be read
+is treated as a miss.
+
+Typical use:
+    cache = batchcache.ResultCache("results")
+    result = batchcache.run_batch(ram, pcb, 1000, [(10, values)], [(12, 1)],
+                                  cache=cache)
+    products = result.get_outputs()[0][:, 0]
+'''
+
+import hashlib
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import batch
+
+# Change this when a change to BatchMachine makes old results wrong.
+CACHE_VERSION = 2
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+_SUFFIX = ".npz"
+
+
+class BatchResult:
+    '''The outcome of a batch run.'''
+
+    def __init__(self, outputs, status, registers, steps):
+        self._outputs = outputs
+        self._status = status
+        self._registers = registers
+        self._steps = steps
+
+    def get_outputs(self):
+        '''Return a list holding, for each output range (addr, count),
+        an array of shape (lanes, count) of the words in it.'''
+        return self._outputs
+
+    def get_status(self):
+        '''Return an array holding batch.RUNNING or the trap reason, per lane.'''
+        return self._status
+
+    def get_registers(self):
+        '''Return a dictionary mapping register name (and 'pc') to an
+        array of that register's value in each lane.'''
+        return self._registers
+
+    def get_steps(self):
+        return self._steps
+
+
+class ResultCache:
+    '''BatchResults stored in directory, at most about max_bytes of them.'''
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._max_bytes = max_bytes
+
+    def get(self, key):
+        '''Return the BatchResult stored under key, or None.'''
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                num_outputs = int(data['num_outputs'])
+                outputs = [data['output%d' % i] for i in range(num_outputs)]
+                registers = {name[len('reg_'):]: data[name]
+                             for name in data.files if name.startswith('reg_')}
+                result = BatchResult(outputs, data['status'], registers, int(data['steps']))
+        except (OSError, KeyError, ValueError):
+            return None
+        try:
+            _touch(path)
+        except OSError:
+            pass                # evicted by another process meanwhile
+        return result
+
+    def put(self, key, result):
+        '''Store result under key, then evict old results if the cache is
+        too big.'''
+        arrays = {'output%d' % i: vals for i, vals in enumerate(result.get_outputs())}
+        arrays.update(('reg_' + name, vals) for name, vals in result.get_registers().items())
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self._directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, num_outputs=len(result.get_outputs()), status=result.get_status(),
+                         steps=result.get_steps(), **arrays)
+            os.replace(tmp, self._path(key))
+            _touch(self._path(key))
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._evict()
+
+    def get_size(self):
+        '''Return the number of bytes the stored results take up.'''
+        return sum(size for _, size, _ in self._entries())
+
+    def clear(self):
+        for _, _, path in self._entries():
+            _remove(path)
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + _SUFFIX)
+
+    def _entries(self):
+        '''Return a list of (last use, size, path) for the stored results.'''
+        entries = []
+        with os.scandir(self._directory) as it:
+            for entry in it:
+                if entry.name.endswith(_SUFFIX):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue        # evicted by another process
+                    entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        return entries
+
+    def _evict(self):
+        '''Delete the least recently used results until the rest fit.'''
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self._max_bytes:
+                break
+            _remove(path)
+            total -= size
+
+
+def _touch(path):
+    '''Mark the result in path as used now.  The time is set explicitly:
+    the file system's own clock may be too coarse to order results.'''
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def make_key(words, entry_point, stack_base, num_lanes, inputs, outputs, max_steps):
+    '''Return the hex digest identifying a batch run: see run_batch().'''
+    h = hashlib.sha256()
+    h.update(repr((CACHE_VERSION, words, entry_point, stack_base, num_lanes,
+                   [tuple(out) for out in outputs], max_steps)).encode('utf-8'))
+    for addr, vals in inputs:
+        h.update(repr((addr, vals.shape)).encode('utf-8'))
+        h.update(vals.tobytes())
+    return h.hexdigest()
+
+
+def run_batch(ram, pcb, num_lanes, inputs, outputs, max_steps=None, cache=None):
+    '''Run num_lanes copies of the process described by pcb on a
+    BatchMachine, and return a BatchResult.
+    inputs is a list of (addr, vals): before the run, the words from
+    logical address addr up are set to vals, either one list of words
+    for all lanes or an array of shape (lanes, count).
+    outputs is a list of (addr, count): the ranges of words to return.
+    If cache (a ResultCache) is given, a run that was made before is
+    not made again: its result comes from the cache.'''
+    words = batch.read_process_words(ram, pcb)
+    inputs = [(addr, _lane_words(vals, num_lanes)) for addr, vals in inputs]
+    key = None
+    if cache is not None:
+        key = make_key(words, pcb.get_entry_point(), pcb.get_stack_base(), num_lanes,
+                       inputs, outputs, max_steps)
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+    machine = batch.BatchMachine(ram, pcb, num_lanes)
+    for addr, vals in inputs:
+        for i in range(vals.shape[1]):
+            machine.set_word(addr + i, vals[:, i])
+    steps = machine.run(max_steps)
+    result = BatchResult([machine.get_words(addr, count) for addr, count in outputs],
+                         machine.get_status(), machine.get_registers(), steps)
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+
+def _lane_words(vals, num_lanes):
+    '''Return vals as an int64 array of shape (num_lanes, count).'''
+    vals = np.asarray(vals, dtype=np.int64)
+    if vals.ndim == 1:
+        vals = np.tile(vals, (num_lanes, 1))
+    if vals.ndim != 2 or vals.shape[0] != num_lanes:
+        raise ValueError("Input words must be one list, or one list per lane")
+    return vals
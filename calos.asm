@@ -1,5 +1,5 @@
 # ttyout code: assume value to print in reg2
-# FOR NOW: assume return address is in reg1
+# Called with call: returns with ret.
 # assume tty registers are:
 # 1020: status
 # 1021: control/command
@@ -16,11 +16,11 @@ mov reg2 1022
 # set command-ready and write bit 
 mov 3 1021
 # return to caller
-jmp reg1
+ret
 
 # ttyin code: read from kbd registers and leave
 # value in reg2.
-# FOR NOW: assume return address is in reg1
+# Called with call: returns with ret.
 # assume tty registers are:
 # 997: status
 # 998: control/command
@@ -37,6 +37,6 @@ mov *998 reg0
 jnz reg0 1009
 # move value to reg2 and return
 mov *999 reg2
-jmp reg1
+ret
 
 
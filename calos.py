@@ -1,11 +1,49 @@
+import asyncio
 import threading
 
+import cpu as cpumodule
+import devices
+from cpu import MAX_CHARS_PER_ADDR, NUM_REGISTERS, PC, REG0, SP
+from memmgr import MemoryManager
+from ram import PAGE_SIZE, RAM_SIZE
+from timingwheel import TimingWheel
+
 DEFAULT_QUANTUM = 3   # very short -- for pedagogical reasons.
+DEFAULT_PRIORITY = 0
+
+# Number of instructions each CPU runs before letting the others run,
+# in run_async().
+ASYNC_SLICE = 100
+
+# Processes are placed in RAM from USER_MEM_LOW up to the end of RAM,
+# except for the kernel memory, from USER_MEM_HIGH up to (not including)
+# KERNEL_MEM_HIGH, the top of the standard RAM: the tty registers and
+# calos.asm live there.  A smaller RAM has only the part that fits.
+USER_MEM_LOW = 0
+USER_MEM_HIGH = 997
+KERNEL_MEM_HIGH = RAM_SIZE
+
+# Words of stack given to each process, above its code and data.
+STACK_SIZE = 32
+
+# Kinds of timers in the timing wheel: (TIMER_SLEEP, pcb) wakes up
+# pcb, and (TIMER_ALARM, pcb, addr) stores 1 at pcb's logical address addr.
+TIMER_SLEEP, TIMER_ALARM = "sleep", "alarm"
 
 class CalOS:
 
     def __init__(self, ram, debug=False):
-        self.syscalls = { "test_syscall": self.test_syscall }
+        # System call handlers, indexed by system call number, and the
+        # numbers, by name.
+        self._syscalls = []
+        self._syscall_nums = {}
+        self.register_syscall("test_syscall", self.test_syscall)
+        self.register_syscall("memcopy", self.memcopy)
+        self.register_syscall("memfill", self.memfill)
+        self.register_syscall("ttywrite", self.ttywrite)
+        self.register_syscall("ttyread", self.ttyread)
+        self.register_syscall("sleep", self.sleep)
+        self.register_syscall("alarm", self.alarm)
         self._ready_q = []
         self._ram = ram
         self._timer_controller = None
@@ -13,41 +51,303 @@ class CalOS:
         self._debug = debug
         self._threads = []
 
+        # The devices.AsyncTTY used by the tty system calls while
+        # run_async() is running.  None means use print(), and the
+        # devices.TTYController, started the first time ttyread is called.
+        self._tty = None
+        self._tty_controller = None
+
+        # The names of the devices this machine has, besides the timer.
+        self._devices = set(devices.DEVICE_NAMES)
+
+        # Processes waiting for a device, and the device requests that
+        # are done but whose processes have not been woken up yet.
+        self._wait_q = []
+        self._io_done = []
+        self._io_lock = threading.Lock()
+
+        # The sleep and alarm timers, in virtual time: the highest cycle
+        # count a CPU has reached when it took a timer interrupt.  Also,
+        # the alarm timer of each process, by pid, and the number of
+        # cycles each cpu's process is going to sleep for, by cpu number.
+        self._timers = TimingWheel()
+        self._alarms = {}
+        self._sleep_for = {}
+
+        # While run_async() is running: set when an idle CPU may have
+        # something to do.
+        self._idle_event = None
+
+        # Held while an interrupt handler runs, so that CPUs enter the
+        # kernel (and change the ready queue) one at a time.
+        self._kernel_lock = threading.RLock()
+
+        # A replay.Recorder that is told about every nondeterministic
+        # event, and a replay.Replayer that supplies them instead.
+        self._recorder = None
+        self._replayer = None
+
+        # The memory given to processes, and the PCB (or TextSegment)
+        # each block belongs to, by start address.
+        self._mem_mgr = MemoryManager(USER_MEM_LOW, ram.get_size())
+        self._kernel_low = min(USER_MEM_HIGH, ram.get_size())
+        self._kernel_high = min(KERNEL_MEM_HIGH, ram.get_size())
+        if self._kernel_high > self._kernel_low:
+            self._mem_mgr.allocate_at(self._kernel_low, self._kernel_high - self._kernel_low)
+        self._mem_owners = {}
+        # The text segments in memory, by their words (as a tuple).
+        self._texts = {}
+
         # Refers to the current process's PCB, per CPU
         self._current_proc = []
 
     def set_cpus(self, cpus):
         '''store a reference to the list of cpus'''
         self._cpus = cpus
-        # Initialize the list of current_procs and threads
-        self._current_proc = [None] * len(self._cpus)
+        # Initialize the list of current_procs and threads.  A clone
+        # arrives with its current_procs already filled in: keep them.
+        if len(self._current_proc) != len(self._cpus):
+            self._current_proc = [None] * len(self._cpus)
         self._threads = [None] * len(self._cpus)
 
     def set_debug(self, debug):
         self._debug = debug
 
-    def syscall(self, fname, val0, val1, val2):
-        if not fname in self.syscalls:
-            print("ERROR: unknown system call", fname)
-            return
-        self.syscalls[fname](val0, val1, val2)
+    def set_devices(self, names):
+        '''Set the names of the devices this machine has (see devices.DEVICE_NAMES).'''
+        self._devices = set(names)
+
+    def set_recorder(self, recorder):
+        self._recorder = recorder
+
+    def set_replayer(self, replayer):
+        self._replayer = replayer
+
+    def get_current_proc(self, cpu_num):
+        '''Return the PCB of the process running on cpu number cpu_num,
+        or None.'''
+        return self._current_proc[cpu_num]
 
-    def test_syscall(self, val0, val1, val2):
+    def clone(self, ram):
+        '''Return a copy of this OS that runs on the given ram, with
+        copies of all the PCBs.  The cpus are not copied: call set_cpus()
+        on the new OS with the cloned cpus.'''
+        other = CalOS(ram, self._debug)
+        other._devices = set(self._devices)
+        # Re-register system calls added after __init__, in number order so
+        # that they get the same numbers in the clone.
+        for name, num in sorted(self._syscall_nums.items(), key=lambda item: item[1]):
+            func = self._syscalls[num]
+            if getattr(func, '__self__', None) is not self:
+                other.register_syscall(name, func)
+        # Clone each PCB and text segment once, even if it is referred
+        # to from several places.
+        clones = {}
+        def clone_text(seg):
+            if seg is not None and id(seg) not in clones:
+                clones[id(seg)] = seg.clone()
+            return None if seg is None else clones[id(seg)]
+        def clone_pcb(pcb):
+            if pcb is None:
+                return None
+            if id(pcb) not in clones:
+                clones[id(pcb)] = pcb.clone()
+                clones[id(pcb)].set_text(clone_text(pcb.get_text()))
+            return clones[id(pcb)]
+        def clone_owner(owner):
+            if isinstance(owner, TextSegment):
+                return clone_text(owner)
+            return clone_pcb(owner)
+        other._ready_q = [clone_pcb(pcb) for pcb in self._ready_q]
+        other._current_proc = [clone_pcb(pcb) for pcb in self._current_proc]
+        other._wait_q = [clone_pcb(pcb) for pcb in self._wait_q]
+        other._timers = self._timers.clone(lambda item: (item[0], clone_pcb(item[1])) + item[2:])
+        other._alarms = {timer.get_item()[1].get_pid(): timer
+                         for timer in other._timers.get_timers()
+                         if timer.get_item()[0] == TIMER_ALARM}
+        other._mem_mgr = self._mem_mgr.clone()
+        other._mem_owners = {start: clone_owner(owner) for start, owner in self._mem_owners.items()}
+        other._texts = {key: clone_text(seg) for key, seg in self._texts.items()}
+        return other
+
+    def register_syscall(self, name, func):
+        '''Make func the handler for the system call called name, and
+        return its system call number.  func is called with the cpu that
+        made the call and the values in reg0, reg1 and reg2.  If it returns
+        a value, that value is put in reg0.  Registering a name again
+        replaces its handler but keeps its number.'''
+        if name in self._syscall_nums:
+            num = self._syscall_nums[name]
+            self._syscalls[num] = func
+        else:
+            num = len(self._syscalls)
+            self._syscalls.append(func)
+            self._syscall_nums[name] = num
+        return num
+
+    def get_syscall_num(self, name):
+        '''Return the number of the system call called name, or None if
+        there is no such system call.'''
+        return self._syscall_nums.get(name)
+
+    def syscall(self, cpu, num, val0, val1, val2):
+        '''Call system call number num on behalf of cpu.  Return the
+        handler's result.'''
+        if not 0 <= num < len(self._syscalls):
+            print("ERROR: unknown system call", num)
+            return None
+        return self._syscalls[num](cpu, val0, val1, val2)
+
+    def test_syscall(self, cpu, val0, val1, val2):
         print("Test system call called!")
 
+    def memcopy(self, cpu, src, dst, count):
+        '''Copy count words from logical address src to logical
+        address dst.  The areas may overlap.'''
+        cpu.get_mmu().copy_block(src, dst, count)
+
+    def memfill(self, cpu, addr, val, count):
+        '''Store val into the count words starting at logical address addr.'''
+        cpu.get_mmu().fill_block(addr, val, count)
+
+    def ttywrite(self, cpu, addr, count, unused):
+        '''Print the count words starting at logical address addr
+        on one line.'''
+        if devices.TTY not in self._devices:
+            print("ERROR: no tty")
+            return
+        vals = cpu.get_mmu().read_block(addr, count)
+        text = " ".join(str(val) for val in vals)
+        if self._tty is None:
+            print(text)
+        else:
+            self._tty.write_line(text)
+
+    def ttyread(self, cpu, addr, count, unused):
+        '''Read count words from the keyboard into memory starting at
+        logical address addr.  Words are separated by white space and may
+        span several lines.  A word that is not a number is stored as a
+        string of up to MAX_CHARS_PER_ADDR characters.  The process waits
+        for the words off the CPU (see block()); when it runs again, reg0
+        holds the number of words read, which is less than count if the
+        input ends.'''
+        if devices.TTY not in self._devices:
+            print("ERROR: no tty")
+            return 0
+        request = devices.IORequest(self._current_proc[cpu.get_num()], addr, count)
+        self.block(cpu)
+        self._get_tty_device().request_read(request, self.io_done)
+
+    def sleep(self, cpu, cycles, unused1, unused2):
+        '''Wait, off the CPU, until at least cycles more cycles have gone by.'''
+        self.block(cpu, max(cycles, 1))
+
+    def alarm(self, cpu, cycles, addr, unused):
+        '''Store 1 at logical address addr once cycles more cycles have
+        gone by, while the process goes on running.  A process has one
+        alarm: setting it cancels the one before, and cycles of 0 just
+        cancels it.  Return the number of cycles that were left on the
+        cancelled alarm, or 0.'''
+        pcb = self._current_proc[cpu.get_num()]
+        with self._kernel_lock:
+            now = self._get_time(cpu)
+            left = self._cancel_alarm(pcb, now)
+            if cycles > 0:
+                self._alarms[pcb.get_pid()] = self._timers.schedule(
+                    now + cycles, (TIMER_ALARM, pcb, addr))
+        return left
+
+    def _cancel_alarm(self, pcb, now):
+        '''Cancel pcb's alarm, if it is set, and return the number of cycles
+        that were left on it.'''
+        timer = self._alarms.pop(pcb.get_pid(), None)
+        if timer is None or timer.is_cancelled():
+            return 0
+        self._timers.cancel(timer)
+        return max(timer.get_deadline() - now, 0)
+
+    def _get_time(self, cpu):
+        '''Return the virtual time, as seen from cpu: the timing wheel is
+        at the highest cycle count any CPU has brought it to, and a CPU
+        whose own count lags behind (e.g., one that was idle) must not
+        set timers in the past.'''
+        return max(cpu.get_cycles(), self._timers.get_time())
+
+    def _run_timers(self, cpu):
+        '''Bring the timing wheel up to the virtual time, and wake the
+        sleeping processes and set off the alarms that are due.'''
+        for item in self._timers.advance(self._get_time(cpu)):
+            pcb = item[1]
+            if item[0] == TIMER_SLEEP:
+                self._wait_q.remove(pcb)
+                self.add_to_ready_q(pcb)
+            else:
+                del self._alarms[pcb.get_pid()]
+                self._write_proc_memory(pcb, item[2], [1])
+
+    def _get_tty_device(self):
+        if self._replayer is not None:
+            return self._replayer
+        if self._tty is not None:
+            return self._tty
+        with self._kernel_lock:
+            if self._tty_controller is None:
+                self._tty_controller = devices.TTYController(self._debug)
+                self._tty_controller.start()
+        return self._tty_controller
+
+    def block(self, cpu, cycles=None):
+        '''Called by a system call that has to wait for a device, or for
+        cycles cycles of virtual time.  Once the call instruction is done, the
+        process running on cpu is moved to the wait queue, and cpu is
+        given to another process.'''
+        if cycles is not None:
+            self._sleep_for[cpu.get_num()] = cycles
+        cpu.raise_interrupt(cpumodule.YIELD_DEV_ID)
+
+    def io_done(self, request):
+        '''Called by a device (from its own thread) when it has finished
+        request.  Interrupt a cpu -- an idle one, if there is one -- to
+        wake up the process that is waiting for it.'''
+        self.complete_io(request)
+        running = [cpu for cpu in self._cpus if not cpu.is_stopped()]
+        idle = [cpu for cpu in running if cpu.is_idle()]
+        if idle or running:
+            (idle or running)[0].raise_interrupt(cpumodule.TTY_DEV_ID)
+        if self._idle_event is not None:
+            self._idle_event.set()
+
+    def complete_io(self, request):
+        '''Note that request is done, without interrupting anyone.'''
+        with self._io_lock:
+            self._io_done.append(request)
+
     def set_timer_controller(self, t):
         self._timer_controller = t
 
     def add_to_ready_q(self, pcb):
-        '''Add pcb to the ready queue, and set the state of the process to READY.'''
-        pcb.set_state(PCB.READY)
-        self._ready_q.append(pcb)
+        '''Add pcb to the ready queue, and set the state of the process to READY.
+        It goes behind the processes with its priority or higher, and
+        ahead of those with lower priority.'''
+        with self._kernel_lock:
+            pcb.set_state(PCB.READY)
+            i = len(self._ready_q)
+            while i > 0 and self._ready_q[i - 1].get_priority() < pcb.get_priority():
+                i -= 1
+            self._ready_q.insert(i, pcb)
 
-        if self._debug:
-            print("add_to_ready_q: queue is now:")
-            for p in self._ready_q:
-                print("\t" + str(p))
-            print("Num ready processes = {}".format(len(self._ready_q)))
+            if self._debug:
+                print("add_to_ready_q: queue is now:")
+                for p in self._ready_q:
+                    print("\t" + str(p))
+                print("Num ready processes = {}".format(len(self._ready_q)))
+
+    def add_procs_to_ready_q(self, pcbs):
+        '''Add all the pcbs to the ready queue at once: no CPU takes any
+        of them off it until all are on it.'''
+        with self._kernel_lock:
+            for pcb in pcbs:
+                self.add_to_ready_q(pcb)
 
     def timer_isr(self, cpu):
         '''Called when the timer expires. If there is no process in the
@@ -57,16 +357,119 @@ class CalOS:
         if self._debug:
             print("End of quantum!")
 
-        if len(self._ready_q) == 0:
-            # Leave current proc in place, as running: just reset the timer.
+        with self._kernel_lock:
+            if self._recorder is not None:
+                self._recorder.record_timer(cpu.get_num(), cpu.get_cycles())
+
+            self._run_timers(cpu)
+
+            if self._current_proc[cpu.get_num()] is None:
+                # An idle cpu: see if there is something to run now.
+                if len(self._ready_q) > 0:
+                    self._assign_proc_to_cpu(cpu)
+                else:
+                    self.reset_timer(cpu)
+                return
+
+            if len(self._ready_q) == 0:
+                # Leave current proc in place, as running: just reset the timer.
+                self.reset_timer(cpu)
+                return
+
+            self.context_switch(cpu)
+
+            # reset the timer (to the quantum of the (new) current_proc).
             self.reset_timer(cpu)
-            return
 
-        self.context_switch(cpu)
 
-        # reset the timer (to the quantum of the (new) current_proc).
+    def yield_isr(self, cpu):
+        '''Called after a system call that called block(): move the
+        process to the wait queue, and run another process if there is
+        one.'''
+        with self._kernel_lock:
+            if self._recorder is not None:
+                self._recorder.record_block(cpu.get_num(), cpu.get_cycles())
+
+            pcb = self._current_proc[cpu.get_num()]
+            pcb.set_registers(cpu.get_registers())
+            pcb.set_state(PCB.WAITING)
+            self._wait_q.append(pcb)
+            self._current_proc[cpu.get_num()] = None
+            # The timer is set here, rather than in the system call, so
+            # that the process is surely waiting when it goes off.
+            cycles = self._sleep_for.pop(cpu.get_num(), None)
+            if cycles is not None:
+                self._timers.schedule(self._get_time(cpu) + cycles, (TIMER_SLEEP, pcb))
+            if self._debug:
+                print("{} is waiting".format(pcb.get_name()))
+
+            # The device may have been quick.
+            self._wake_waiting(cpu)
+
+            if len(self._ready_q) > 0:
+                self._assign_proc_to_cpu(cpu)
+            else:
+                self._go_idle(cpu)
+
+    def tty_isr(self, cpu):
+        '''Called when the tty has finished a read: wake up the process
+        that was waiting for it.'''
+        with self._kernel_lock:
+            self._wake_waiting(cpu)
+            if self._current_proc[cpu.get_num()] is None and len(self._ready_q) > 0:
+                self._assign_proc_to_cpu(cpu)
+
+    def _wake_waiting(self, cpu):
+        '''Move the processes whose device requests are done from the wait
+        queue to the ready queue, with their results in place.'''
+        with self._io_lock:
+            done = [request for request in self._io_done
+                    if request.get_pcb().get_state() == PCB.WAITING]
+            for request in done:
+                self._io_done.remove(request)
+        for request in done:
+            pcb = request.get_pcb()
+            words = request.get_words()
+            if self._recorder is not None:
+                self._recorder.record_io(cpu.get_num(), cpu.get_cycles(), pcb.get_pid(), words)
+            vals = []
+            for word in words:
+                try:
+                    vals.append(int(word, 0))
+                except ValueError:
+                    vals.append("'" + word.strip("'")[:MAX_CHARS_PER_ADDR] + "'")
+            self._write_proc_memory(pcb, request.get_addr(), vals)
+            pcb.get_registers()[REG0] = len(vals)
+            self._wait_q.remove(pcb)
+            self.add_to_ready_q(pcb)
+
+    def _write_proc_memory(self, pcb, addr, vals):
+        '''Store vals at logical address addr of pcb, which is not running.'''
+        if addr < 0 or addr + len(vals) > pcb.get_high_mem() - pcb.get_low_mem():
+            print("BAD ADDRESS!: {} is not in {}".format(addr, pcb.get_name()))
+            return
+        if pcb.get_text() is not None and vals and addr < pcb.get_text().get_size():
+            print("BAD ADDRESS!: {} is in the code of {}".format(addr, pcb.get_name()))
+            return
+        page_table = pcb.get_page_table()
+        if page_table is not None and vals:
+            for page in range(addr // PAGE_SIZE, (addr + len(vals) - 1) // PAGE_SIZE + 1):
+                if not page_table[page]:
+                    self._load_page(pcb, page)
+        self._ram.write_block(pcb.get_low_mem() + addr, vals)
+
+    def _go_idle(self, cpu):
+        '''Leave cpu with no process, until a waiting process is woken up.'''
+        self._current_proc[cpu.get_num()] = None
+        cpu.set_idle(True)
         self.reset_timer(cpu)
 
+    def _stop_idle_cpus(self):
+        for cpu in self._cpus:
+            if cpu.is_idle():
+                cpu.set_stop_cpu(True)
+        if self._idle_event is not None:
+            self._idle_event.set()
 
     def trap_isr(self, cpu, reason):
         '''Called when a software trap has been generated. The reason is
@@ -76,21 +479,37 @@ class CalOS:
         # at this point, if we get a trap, we won't be starting that
         # process again -- it is done, normally or due to error.
 
-        import cpu as cpumodule
         if reason == cpumodule.END_OF_PROGRAM:
             print("PROGRAM ENDED NORMALLY")
         elif reason == cpumodule.ILLEGAL_ADDRESS:
             print("BAD ADDRESS: ENDING PROGRAM")
         elif reason == cpumodule.ILLEGAL_INSTRUCTION:
             print("BAD INSTRUCTION: ENDING PROGRAM")
+        elif reason == cpumodule.DIVIDE_BY_ZERO:
+            print("DIVIDE BY ZERO: ENDING PROGRAM")
 
-        # Program ended.  Context switch to first process
-        # in the ready queue, if available.
-        if len(self._ready_q) > 0:
-            self._assign_proc_to_cpu(cpu)
-        else:
-            # No more processes to run, so stop the CPU.
-            cpu.set_stop_cpu(True)
+        with self._kernel_lock:
+            if self._recorder is not None:
+                self._recorder.record_trap(cpu.get_num(), cpu.get_cycles())
+
+            # The process is done: its memory can be given to new processes.
+            old_proc = self._current_proc[cpu.get_num()]
+            old_proc.set_state(PCB.DONE)
+            self._cancel_alarm(old_proc, self._get_time(cpu))
+            self.free_memory(old_proc)
+
+            # Program ended.  Context switch to first process
+            # in the ready queue, if available.
+            if len(self._ready_q) > 0:
+                self._assign_proc_to_cpu(cpu)
+            elif len(self._wait_q) > 0:
+                # Wait for the waiting processes to be woken up.
+                self._go_idle(cpu)
+            else:
+                # No more processes to run, so stop the CPU, and any
+                # idle ones.
+                cpu.set_stop_cpu(True)
+                self._stop_idle_cpus()
 
 
     def context_switch(self, cpu):
@@ -105,20 +524,197 @@ class CalOS:
         if self._debug:
             print("Switching procs from {} to {}".format(old_proc.get_name(), new_proc.get_name()))
 
-        # squirrel away the registers in the pcb
+        # squirrel away the registers in the pcb.  Both copies are done in
+        # place, so switching does not allocate.
         old_proc.set_registers(cpu.get_registers())
         cpu.set_registers(new_proc.get_registers())
-        cpu.set_mmu_registers(new_proc.get_low_mem(),
-                              new_proc.get_high_mem() - new_proc.get_low_mem())
+        self._set_mmu(cpu, new_proc)
 
         self.add_to_ready_q(old_proc)
         new_proc.set_state(PCB.RUNNING)
         self._current_proc[cpu.get_num()] = new_proc
 
+    def allocate_memory(self, pcb, size, startaddr=None, stack_size=STACK_SIZE, text=None):
+        '''Give pcb a block of size words of RAM, for its code and data,
+        plus stack_size words for its stack, and set its memory limits to
+        the block.  The stack is at the top of the block: pcb's stack base
+        is set to the logical address of its bottom, and its sp to the
+        limit (the stack is empty).  The block starts at
+        startaddr, if given; otherwise it is put wherever there is room,
+        compacting memory first if no free block is big enough.  Return
+        the start address, or None if the memory is not available.
+        If text is given, it is the list of words of pcb's code, which
+        come first in its memory.  pcb then shares the loaded copy of that
+        code with the other processes running it (see TextSegment), and
+        the block only holds the rest of its memory: the start address
+        returned is that of the word after the code.  text cannot be
+        given with startaddr.
+        A block that is all in kernel memory (e.g., calos.asm, loaded at
+        1000 by hand) is not the memory manager's to give out: it is
+        used as is, and gets no stack -- its code runs on its caller's.'''
+        if (startaddr is not None and self._kernel_low <= startaddr and
+                startaddr + max(size, 1) <= self._kernel_high):
+            size = max(size, 1)
+            pcb.set_low_mem(startaddr)
+            pcb.set_high_mem(startaddr + size)
+            pcb.set_stack_base(size)
+            pcb.get_registers()[SP] = size
+            return startaddr
+        size = max(size, 1) + stack_size
+        seg = None
+        text_size = 0
+        if text is not None:
+            seg = self._share_text(text)
+            if seg is None:
+                return None
+            text_size = seg.get_size()
+        if startaddr is None:
+            start = self._allocate(size - text_size)
+            if start is None:
+                if seg is not None:
+                    self._release_text(seg)
+                return None
+        else:
+            if (not self._ram.is_legal_range(startaddr, size) or
+                    not self._mem_mgr.allocate_at(startaddr, size)):
+                return None
+            start = startaddr
+        # The block holds logical addresses text_size and up.
+        pcb.set_low_mem(start - text_size)
+        pcb.set_high_mem(start - text_size + size)
+        pcb.set_text(seg)
+        pcb.set_stack_base(size - stack_size)
+        pcb.get_registers()[SP] = size
+        self._mem_owners[start] = pcb
+        return start
+
+    def load_program(self, pcb, image, startaddr=None, demand=False):
+        '''Give pcb memory for the program on image (a tape.TapeImage),
+        put the program in it, and set pcb's entry point.  The memory
+        starts at startaddr, if given; otherwise it is wherever there is
+        room, and the code is shared with the other processes running it.
+        If demand is True, nothing is copied now: each page is copied in
+        the first time the process touches it.  Return the physical
+        address of pcb's logical address 0, or None if the memory is not
+        available.'''
+        if startaddr is not None and not self._ram.is_legal_range(startaddr, len(image)):
+            return None
+        size = image.get_mem_size()
+        if size is None:
+            size = len(image)
+        text = None
+        if startaddr is None and not demand and image.get_code_size() > 0:
+            # Processes running the same code share one copy of it.
+            text = image.get_words()[:image.get_code_size()]
+        if self.allocate_memory(pcb, size, startaddr, text=text) is None:
+            return None
+        startaddr = pcb.get_low_mem()
+        if image.get_entry_point() is not None:
+            pcb.set_entry_point(image.get_entry_point())
+        if demand:
+            pcb.set_demand_image(image.get_words())
+        elif text is not None:
+            self._ram.write_block(startaddr + len(text), image.get_words()[len(text):])
+        else:
+            self._ram.write_block(startaddr, image.get_words())
+        return startaddr
+
+    def _allocate(self, size):
+        '''Allocate size words wherever there is room, compacting memory
+        if need be.  Return the start address, or None.'''
+        start = self._mem_mgr.allocate(size)
+        if start is None:
+            self.compact_memory()
+            start = self._mem_mgr.allocate(size)
+        return start
+
+    def _share_text(self, words):
+        '''Return the text segment holding the code words, with one more
+        user, loading it into memory if no process is using it yet.
+        Return None if there is no room for it.'''
+        key = tuple(words)
+        with self._kernel_lock:
+            seg = self._texts.get(key)
+            if seg is None:
+                start = self._allocate(len(words))
+                if start is None:
+                    return None
+                self._ram.write_block(start, words)
+                seg = TextSegment(key, start, len(words))
+                self._texts[key] = seg
+                self._mem_owners[start] = seg
+            seg.add_user()
+            return seg
+
+    def _release_text(self, seg):
+        '''Drop one user of seg, freeing its memory when it has none.'''
+        with self._kernel_lock:
+            if seg.remove_user() == 0:
+                del self._texts[seg.get_key()]
+                del self._mem_owners[seg.get_start()]
+                self._mem_mgr.free(seg.get_start())
+
+    def free_memory(self, pcb):
+        '''Give back the memory block that belongs to pcb, if any, and its
+        use of its text segment.'''
+        seg = pcb.get_text()
+        start = pcb.get_low_mem() + (0 if seg is None else seg.get_size())
+        if self._mem_owners.get(start) is pcb:
+            del self._mem_owners[start]
+            self._mem_mgr.free(start)
+            if seg is not None:
+                self._release_text(seg)
+
+    def compact_memory(self):
+        '''Move the memory of all processes that are not running, and the
+        text segments no running process uses, down to lower addresses,
+        so that the free memory is in as few pieces as possible.  A
+        process's code uses logical addresses, so only its PCB's memory
+        limits (or its text segment's start) have to change.'''
+        running = [pcb for pcb in self._current_proc if pcb is not None]
+        def is_movable(start):
+            owner = self._mem_owners.get(start)
+            if isinstance(owner, TextSegment):
+                return not any(pcb.get_text() is owner for pcb in running)
+            return owner is not None and owner.get_state() != PCB.RUNNING
+
+        for old, new, size in self._mem_mgr.compact(is_movable):
+            self._ram.copy_block(old, new, size)
+            owner = self._mem_owners.pop(old)
+            self._mem_owners[new] = owner
+            if isinstance(owner, TextSegment):
+                owner.set_start(new)
+                if self._debug:
+                    print("Moved code of {} users from {} to {}".format(owner.get_users(), old, new))
+                continue
+            owner.set_low_mem(owner.get_low_mem() - (old - new))
+            owner.set_high_mem(owner.get_high_mem() - (old - new))
+            if self._debug:
+                print("Moved {} from {} to {}".format(owner.get_name(), old, new))
+
+    def page_fault_isr(self, cpu, page):
+        '''Called when the process running on cpu touches a logical page
+        that is not in memory yet.  Copy the part of the process's tape
+        that belongs in that page into memory, and mark it present.
+        Words past the end of the tape (data) are left alone, so values
+        put there before the process ran are kept.'''
+        self._load_page(self._current_proc[cpu.get_num()], page)
+
+    def _load_page(self, pcb, page):
+        image = pcb.get_demand_image()
+        start = page * PAGE_SIZE
+        words = image[start:start + PAGE_SIZE]
+        if words:
+            self._ram.write_block(pcb.get_low_mem() + start, words)
+        pcb.get_page_table()[page] = True
+        if self._debug:
+            print("Page fault: {} page {} loaded".format(pcb.get_name(), page))
+
     def reset_timer(self, cpu):
         '''Reset the timer's countdown to the value in the current_proc's
-        PCB.'''
-        cpu.reset_timer(self._current_proc[cpu.get_num()].get_quantum())
+        PCB, or to the default quantum if the cpu is idle.'''
+        pcb = self._current_proc[cpu.get_num()]
+        cpu.reset_timer(DEFAULT_QUANTUM if pcb is None else pcb.get_quantum())
 
     def run(self):
         '''Execute processes in the ready queue on all cpus --
@@ -134,17 +730,15 @@ class CalOS:
         # Start each thread.
         # Join all threads.
 
-        for idx in range(len(self._cpus)):
-            if len(self._ready_q) == 0:
-                break
-            cpu = self._cpus[idx]
-            self._threads[idx] = threading.Thread(target=cpu.run_cpu)
-
-            self._assign_proc_to_cpu(cpu)
-            cpu.set_stop_cpu(False)   # power up the CPU.
+        # Only the cpus that will get a process are started, and only
+        # they get a timer thread.
+        for cpu in self._cpus[:len(self._ready_q)]:
+            if cpu.get_clock_mode() == cpumodule.CLOCK_THREAD and cpu.get_timer() is None:
+                cpu.set_timer(devices.TimerController(cpu, cpumodule.TIMER_DEV_ID, self._debug))
 
-            if self._debug:
-                print("Running", self._current_proc[cpu.get_num()])
+        self._threads = [None] * len(self._cpus)
+        for cpu in self.start_cpus():
+            self._threads[cpu.get_num()] = threading.Thread(target=cpu.run_cpu)
 
         # Start all the CPUs
         for t in self._threads:
@@ -157,41 +751,167 @@ class CalOS:
             if self._threads[idx] is None:
                 continue
             self._threads[idx].join()
+            # Let the timer thread sleep until the next run.
+            cpu.stop_timer()
             if self._debug:
                 print("CalOS.run(): done with", cpu)
 
             # TODO: move this to isr where end is handled.  Maybe.
-            self._current_proc[cpu.get_num()].set_state(PCB.DONE)
+            if self._current_proc[cpu.get_num()] is not None:
+                self._current_proc[cpu.get_num()].set_state(PCB.DONE)
 
             if self._debug:
                 print("Done running {}, num ready_processes now {}".
                       format(self._current_proc[cpu.get_num()], len(self._ready_q)))
 
+    def start_cpus(self):
+        '''Give each cpu the first process in the ready queue, and power
+        it up.  Return the list of cpus started: if there are fewer
+        processes than cpus, some are left off.'''
+        started = []
+        for cpu in self._cpus:
+            if len(self._ready_q) == 0:
+                break
+            self._assign_proc_to_cpu(cpu)
+            cpu.set_stop_cpu(False)   # power up the CPU.
+            started.append(cpu)
+
+            if self._debug:
+                print("Running", self._current_proc[cpu.get_num()])
+        return started
+
+    async def run_async(self, tty=None, slice_size=ASYNC_SLICE):
+        '''Like run(), but without threads: each CPU is a coroutine in
+        the running event loop, which executes slice_size instructions
+        at a time and then lets the other coroutines run.  The timer
+        counts instructions (CLOCK_CYCLES) instead of being a thread, and
+        the tty system calls use tty, a devices.AsyncTTY (by default,
+        one that uses standard input and output).  Because nothing blocks
+        the thread, many machines can be run at once, e.g.:
+            await asyncio.gather(*(m.get_os().run_async() for m in machines))
+        '''
+        if tty is None:
+            tty = devices.AsyncTTY()
+        self._tty = tty
+        self._idle_event = asyncio.Event()
+
+        clock_modes = [cpu.get_clock_mode() for cpu in self._cpus]
+        for cpu in self._cpus:
+            cpu.set_clock_mode(cpumodule.CLOCK_CYCLES)
+        try:
+            running = self.start_cpus()
+            await asyncio.gather(*(self._run_cpu_async(cpu, slice_size)
+                                   for cpu in running))
+        finally:
+            self._tty = None
+            self._idle_event = None
+            for cpu, clock_mode in zip(self._cpus, clock_modes):
+                cpu.set_clock_mode(clock_mode)
+
+        for cpu in running:
+            if self._current_proc[cpu.get_num()] is not None:
+                self._current_proc[cpu.get_num()].set_state(PCB.DONE)
+
+    async def _run_cpu_async(self, cpu, slice_size):
+        while not cpu.is_stopped():
+            cpu.run_slice(slice_size)
+            if cpu.is_idle() and not cpu.is_stopped() and len(self._timers) == 0:
+                # Nothing to do until a device finishes.  (No await before
+                # clear(), so a set() since the slice cannot be missed.)
+                self._idle_event.clear()
+                await self._idle_event.wait()
+            else:
+                # Let the other CPUs run.
+                await asyncio.sleep(0)
+            await self._tty.drain()
+
     def _assign_proc_to_cpu(self, cpu):
         new_proc = self._ready_q.pop(0)
         self._current_proc[cpu.get_num()] = new_proc
+        cpu.set_idle(False)
         self.reset_timer(cpu)
         cpu.set_registers(new_proc.get_registers())
-        cpu.set_mmu_registers(new_proc.get_low_mem(),
-                              new_proc.get_high_mem() - new_proc.get_low_mem())
+        self._set_mmu(cpu, new_proc)
         new_proc.set_state(PCB.RUNNING)
 
+    def _set_mmu(self, cpu, pcb):
+        '''Point cpu's MMU at pcb's memory.'''
+        cpu.set_mmu_registers(pcb.get_low_mem(), pcb.get_high_mem() - pcb.get_low_mem())
+        cpu.set_stack_base(pcb.get_stack_base())
+        seg = pcb.get_text()
+        if seg is None:
+            cpu.set_text_segment(0, 0)
+        else:
+            cpu.set_text_segment(seg.get_start(), seg.get_size())
+        cpu.set_page_table(pcb.get_page_table())
+
+
+class TextSegment:
+    '''The code of a program, loaded into memory once and shared by all
+    the processes running it.  Processes cannot change their code, so
+    they can all use the same copy: each needs memory of its own only
+    for its data and stack.'''
+
+    __slots__ = ('_key', '_start', '_size', '_users')
+
+    def __init__(self, key, start, size):
+        self._key = key
+        self._start = start
+        self._size = size
+        # Number of processes using this segment.
+        self._users = 0
+
+    def get_key(self):
+        return self._key
+
+    def get_start(self):
+        return self._start
+
+    def set_start(self, start):
+        self._start = start
+
+    def get_size(self):
+        return self._size
+
+    def get_users(self):
+        return self._users
+
+    def add_user(self):
+        self._users += 1
+
+    def remove_user(self):
+        '''Drop a user, and return the number of users left.'''
+        self._users -= 1
+        return self._users
+
+    def clone(self):
+        other = TextSegment(self._key, self._start, self._size)
+        other._users = self._users
+        return other
+
+
 class PCB:
     '''Process control block'''
 
     NEW, READY, RUNNING, WAITING, DONE = "NEW", "READY", "RUNNING", "WAITING", "DONE"
     LEGAL_STATES = NEW, READY, RUNNING, WAITING, DONE
 
+    __slots__ = ('_name', '_pid', '_entry_point', '_mem_low', '_mem_high', '_state',
+                 '_registers', '_quantum', '_priority', '_demand_image', '_page_table',
+                 '_text', '_stack_base')
+
     # PID 0 is reserved for the IDLE process, which runs when there are no other
     # ready processes.
     next_pid = 1
+
+    # The pid of a PCB that is not a process yet: see assign_pid().
+    NO_PID = -1
     
     def __init__(self, name, pid=None):
 
         self._name = name
         if pid is None:
-            self._pid = PCB.next_pid
-            PCB.next_pid += 1
+            self.assign_pid()
         else:
             self._pid = pid
 
@@ -199,25 +919,36 @@ class PCB:
 
         # These addresses define the limits of the memory assigned for this process.
         # The mem_low also represents the offset used for translation of logical
-        # addresses in code to physical addresses in RAM.
+        # addresses in code to physical addresses in RAM.  If the process has a
+        # text segment, its code is not there: only the memory from mem_low plus
+        # the size of the text segment up is the process's own.
         self._mem_low = None
         self._mem_high = None
+        # The shared TextSegment holding the process's code, or None.
+        self._text = None
+        # The logical address of the bottom of the stack: pushing below
+        # it is a stack overflow.  0 means no limit but the memory's own.
+        self._stack_base = 0
         self._state = PCB.NEW
 
         # Used for storing state of the process's registers when it is not running.
-        self._registers = {
-            'reg0' : 0,
-            'reg1' : 0,
-            'reg2' : 0,
-            'pc': 0
-            }
+        # Like the CPU's register file, it is only ever updated in place.
+        self._registers = [0] * NUM_REGISTERS
 
         # Quantum: how long this process runs before being interrupted.
         self._quantum = DEFAULT_QUANTUM
+        # Processes with higher priority go ahead of it in the ready queue.
+        self._priority = DEFAULT_PRIORITY
+
+        # For a demand-paged process: the words of its tape, and whether
+        # each (logical) page has been copied into memory yet.  Both are
+        # None if the process was loaded into memory in full.
+        self._demand_image = None
+        self._page_table = None
 
     def set_entry_point(self, addr):
         self._entry_point = addr
-        self._registers['pc'] = addr
+        self._registers[PC] = addr
 
     def get_entry_point(self):
         return self._entry_point
@@ -234,6 +965,37 @@ class PCB:
     def get_high_mem(self):
         return self._mem_high
 
+    def get_stack_base(self):
+        return self._stack_base
+
+    def set_stack_base(self, base):
+        self._stack_base = base
+
+    def set_text(self, seg):
+        self._text = seg
+
+    def get_text(self):
+        return self._text
+
+    def set_demand_image(self, words):
+        '''Make this a demand-paged process, whose memory is filled from
+        the words of its tape as it touches each page.  No page is in
+        memory yet.  Call this after setting the high memory limit.'''
+        self._demand_image = words
+        if self._mem_high is None:
+            size = len(words)
+        else:
+            size = self._mem_high - self._mem_low
+        self._page_table = [False] * ((size + PAGE_SIZE - 1) // PAGE_SIZE)
+
+    def get_demand_image(self):
+        return self._demand_image
+
+    def get_page_table(self):
+        '''Return the list of page present flags, or None if the process
+        is not demand-paged.'''
+        return self._page_table
+
     def set_state(self, st):
         assert st in self.LEGAL_STATES
         self._state = st
@@ -242,8 +1004,9 @@ class PCB:
         return self._state
 
     def set_registers(self, registers):
-        # Make a copy of the register dictionary being passed in. We don't want aliasing here.
-        self._registers = dict(registers)
+        # Copy the register file being passed in, in place. We don't want aliasing here,
+        # and a context switch should not have to allocate a new one.
+        self._registers[:] = registers
         
     def get_registers(self):
         return self._registers
@@ -254,12 +1017,40 @@ class PCB:
     def set_quantum(self, q):
         self._quantum = q
 
+    def get_priority(self):
+        return self._priority
+
+    def set_priority(self, priority):
+        self._priority = priority
+
     def get_pid(self):
         return self._pid
 
+    def assign_pid(self):
+        '''Give this PCB the next unused pid.'''
+        self._pid = PCB.next_pid
+        PCB.next_pid += 1
+
     def get_name(self):
         return self._name
 
+    def clone(self):
+        '''Return a copy of this PCB, with the same pid.'''
+        other = PCB(self._name, self._pid)
+        other._entry_point = self._entry_point
+        other._mem_low = self._mem_low
+        other._mem_high = self._mem_high
+        other._state = self._state
+        other.set_registers(self._registers)
+        other._quantum = self._quantum
+        other._priority = self._priority
+        other._demand_image = self._demand_image
+        other._text = self._text
+        other._stack_base = self._stack_base
+        if self._page_table is not None:
+            other._page_table = list(self._page_table)
+        return other
+
     def __str__(self):
         return "PCB({}): {}, state {}, entrypoint {}, mem {}-{}".\
             format(self._pid, self._name, self._state, self._entry_point,
@@ -0,0 +1,89 @@
+'''Describe a machine -- how many CPUs, how much RAM, which devices, and
+how the clock runs -- in an INI file, e.g.:
+
+[machine]
+cpus = 4
+ram_size = 4096
+clock = cycles
+debug = no
+
+[devices]
+tty = yes
+
+Anything left out gets its default: the machine the monitor has always
+built.  Use machine.build_machine() to build the machine.
+'''
+
+import configparser
+
+import cpu as cpumodule
+import devices
+from ram import RAM_SIZE
+
+DEFAULT_NUM_CPUS = 2
+
+# Values of the clock setting.
+CLOCKS = (cpumodule.CLOCK_THREAD, cpumodule.CLOCK_CYCLES)
+
+
+class MachineConfig:
+
+    def __init__(self, num_cpus=DEFAULT_NUM_CPUS, ram_size=RAM_SIZE,
+                 clock_mode=cpumodule.CLOCK_THREAD, device_names=devices.DEVICE_NAMES,
+                 debug=False):
+        if num_cpus < 1:
+            raise ValueError("A machine needs at least 1 cpu")
+        if ram_size < 1:
+            raise ValueError("A machine needs some RAM")
+        if clock_mode not in CLOCKS:
+            raise ValueError("Unknown clock: " + str(clock_mode))
+        for name in device_names:
+            if name not in devices.DEVICE_NAMES:
+                raise ValueError("Unknown device: " + name)
+        self._num_cpus = num_cpus
+        self._ram_size = ram_size
+        self._clock_mode = clock_mode
+        self._device_names = tuple(device_names)
+        self._debug = debug
+
+    def get_num_cpus(self):
+        return self._num_cpus
+
+    def get_ram_size(self):
+        return self._ram_size
+
+    def get_clock_mode(self):
+        return self._clock_mode
+
+    def get_device_names(self):
+        return self._device_names
+
+    def get_debug(self):
+        return self._debug
+
+
+def read_config(filename):
+    '''Read the machine description in filename and return its
+    MachineConfig.  Raises FileNotFoundError if there is no such file,
+    and ValueError if a setting is bad.'''
+    parser = configparser.ConfigParser()
+    with open(filename, "r") as f:
+        try:
+            parser.read_file(f)
+        except configparser.Error as e:
+            raise ValueError(str(e))
+    try:
+        machine = parser["machine"] if parser.has_section("machine") else {}
+        num_cpus = int(machine.get("cpus", DEFAULT_NUM_CPUS))
+        ram_size = int(machine.get("ram_size", RAM_SIZE))
+        clock_mode = machine.get("clock", cpumodule.CLOCK_THREAD).strip().lower()
+        debug = parser.getboolean("machine", "debug", fallback=False)
+        device_names = [name for name in devices.DEVICE_NAMES
+                        if parser.getboolean("devices", name, fallback=True)]
+        if parser.has_section("devices"):
+            for name in parser["devices"]:
+                if name not in devices.DEVICE_NAMES:
+                    raise ValueError("Unknown device: " + name)
+    except configparser.Error as e:
+        raise ValueError(str(e))
+    return MachineConfig(num_cpus, ram_size, clock_mode, device_names, debug)
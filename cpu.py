@@ -1,14 +1,34 @@
+import operator
 import time
 import threading   # for CPU
 
+from ram import MMU
+
 MAX_CHARS_PER_ADDR = 4
 
 # Time to delay between executing instructions, in seconds.
 DELAY_BETWEEN_INSTRUCTIONS = 0.2
 
-# Interrrupt device ids
+# Clock modes.  With CLOCK_THREAD, the timer is a TimerController thread
+# that counts down in real time, and the CPU waits DELAY_BETWEEN_INSTRUCTIONS
+# after each instruction.  With CLOCK_CYCLES, the timer counts executed
+# instructions (cycles), and the CPU runs flat out.
+# With CLOCK_EXTERNAL, the timer does nothing by itself: timer interrupts
+# are raised from outside, with raise_interrupt() (see replay.py).
+CLOCK_THREAD = "thread"
+CLOCK_CYCLES = "cycles"
+CLOCK_EXTERNAL = "external"
+
+# Interrrupt device ids.  Interrupts raised during the same instruction
+# are handled in order of device id.
 SOFTWARE_TRAP_DEV_ID = 0
-TIMER_DEV_ID  = 1
+# Raised by the OS during a system call that has to wait for a device, so
+# that the process gives up the CPU once the call instruction is done --
+# before the timer can switch to another process.
+YIELD_DEV_ID  = 1
+TIMER_DEV_ID  = 2
+# Raised when the tty has finished a read.
+TTY_DEV_ID    = 3
 # KBRD_DEV_ID   = 1
 # SCREEN_DEV_ID = 2
 
@@ -16,10 +36,26 @@ TIMER_DEV_ID  = 1
 END_OF_PROGRAM = 0
 ILLEGAL_ADDRESS = 1
 ILLEGAL_INSTRUCTION = 2
+DIVIDE_BY_ZERO = 3
+
+# The register file is a list with a fixed slot for each register.
+# flags is set by cmp.  sp, the stack pointer, holds the logical address
+# of the word on top of the stack: the stack grows down from the MMU
+# limit, so sp equal to the limit means the stack is empty, down to the
+# stack base (see set_stack_base()).
+REG0, REG1, REG2, PC, FLAGS, SP = 0, 1, 2, 3, 4, 5
+REGISTER_NAMES = ('reg0', 'reg1', 'reg2', 'pc', 'flags', 'sp')
+NUM_REGISTERS = len(REGISTER_NAMES)
+# slot in the register file, by register name.
+REGISTER_INDEX = { name: idx for idx, name in enumerate(REGISTER_NAMES) }
 
 
 class CPU:
 
+    __slots__ = ('_num', '_registers', '_os', '_debug', '_stop', '_intr_raised',
+                 '_intr_addrs', '_intr_lock', '_intr_vector', '_timer', '_mmu',
+                 '_clock_mode', '_cycles', '_deadline', '_idle', '_stack_base')
+
     def __init__(self, ram, os, num=0):
 
         # TODO: the CPU should know nothing about the OS.  The CPU should
@@ -30,7 +66,8 @@ class CPU:
         # etc.
 
         self._num = num   # unique ID of this cpu
-        self.clear_registers()
+        # The register file.  It is only ever updated in place.
+        self._registers = [0] * NUM_REGISTERS
 
         self._os = os
         self._debug = False
@@ -41,32 +78,39 @@ class CPU:
         self._intr_addrs = set()
 
         self._intr_lock = threading.Lock()
+
+        self._clock_mode = CLOCK_THREAD
+        # Number of instructions executed, and, with CLOCK_CYCLES, the
+        # cycle at which the timer expires (None if it is not running).
+        self._cycles = 0
+        self._deadline = None
+
+        # True when the OS has no process for this CPU to run, but
+        # processes are waiting for devices: see set_idle().
+        self._idle = False
+
+        # The lowest logical address the stack may grow down to.
+        self._stack_base = 0
         
         self._intr_vector = [self._trap_isr,
-                             self._timer_isr]
-
-        # Create device controller threads.
-        # This is done here so that when the CPU is done running a program,
-        # the screen and kbd threads can be killed.  Then if it is told
-        # to start up again, it will create new threads (since you cannot
-        # restart stopped threads).
-        # TODO: revisit the above decision?  CPU thread is not stopped anymore...
-        # Also, not using the Keyboard and Screen devices...
-        # And, it seems weird for the CPU to start up the other device controllers...
-        import devices
-        self._timer = devices.TimerController(self, TIMER_DEV_ID, self._debug)
+                             self._yield_isr,
+                             self._timer_isr,
+                             self._tty_isr]
+
+        # The TimerController used with CLOCK_THREAD.  The OS attaches
+        # one when it first runs the CPU (see set_timer()), so that CPUs
+        # that never run -- e.g., clones that are only inspected, or spare
+        # cores -- do not cost a thread each.
+        self._timer = None
 
         # Create MMU.
-        from ram import MMU
         self._mmu = MMU(ram)
-
-        # Start up the thread, though its countdown will be -1, so it won't do anything
-        # until that is set.
-        self._timer.start()
+        self._mmu.set_fault_handler(self._page_fault_isr)
+        self._mmu.set_protection_handler(self._protection_fault_isr)
 
     def set_pc(self, pc):
         # TODO: check if value of pc is good?
-        self._registers['pc'] = pc
+        self._registers[PC] = pc
 
     def get_num(self):
         """return the index of this CPU in the system"""
@@ -74,7 +118,8 @@ class CPU:
 
     def set_debug(self, debug):
         self._debug = debug
-        self._timer.set_debug(debug)
+        if self._timer is not None:
+            self._timer.set_debug(debug)
 
     def take_interrupt_mutex(self):
         self._intr_lock.acquire()
@@ -94,35 +139,103 @@ class CPU:
         raised an interrupt.'''
         self._intr_addrs.add(addr)
 
+    def raise_interrupt(self, addr):
+        '''Raise an interrupt for the device with bus address addr.  It is
+        handled after the next instruction.'''
+        self.take_interrupt_mutex()
+        self.add_interrupt_addr(addr)
+        self.set_interrupt(True)
+        self.release_interrupt_mutex()
+
     def get_registers(self):
         return self._registers
 
     def set_registers(self, registers):
-        if registers == {}:
+        '''Copy the register file registers into this CPU's register file.
+        The copy is done in place, so no new list is made and we don't
+        have multiple references to it.'''
+        if len(registers) != NUM_REGISTERS:
             raise ValueError
-        # make a copy of the registers so that we don't have multiple references to it.
-        self._registers = dict(registers)
+        self._registers[:] = registers
 
     def clear_registers(self):
-        self._registers = {
-            'reg0' : 0,
-            'reg1' : 0,
-            'reg2' : 0,
-            'pc': 0
-            }
+        self._registers[:] = [0] * NUM_REGISTERS
 
     def isregister(self, s):
-        return s in ('reg0', 'reg1', 'reg2', 'pc')
+        return s in REGISTER_INDEX
 
     def __str__(self):
-        res = '''CPU {}: pc {}, reg0 {}, reg1 {}, reg2 {}'''.format(
-            self._num, self._registers['pc'], self._registers['reg0'],
-            self._registers['reg1'], self._registers['reg2'])
+        res = '''CPU {}: pc {}, reg0 {}, reg1 {}, reg2 {}, flags {}, sp {}'''.format(
+            self._num, self._registers[PC], self._registers[REG0],
+            self._registers[REG1], self._registers[REG2], self._registers[FLAGS],
+            self._registers[SP])
         return res
 
+    def set_clock_mode(self, mode):
+        assert mode in (CLOCK_THREAD, CLOCK_CYCLES, CLOCK_EXTERNAL)
+        self._clock_mode = mode
+
+    def get_clock_mode(self):
+        return self._clock_mode
+
+    def get_cycles(self):
+        '''Return the number of instructions this CPU has executed.'''
+        return self._cycles
+
+    def is_stopped(self):
+        return self._stop
+
     def reset_timer(self, quantum):
+        if self._clock_mode == CLOCK_CYCLES:
+            self._deadline = self._cycles + quantum
+            return
+        if self._clock_mode == CLOCK_EXTERNAL or self._timer is None:
+            return
+        if not self._timer.is_alive():
+            self._timer.start()
         self._timer.set_countdown(quantum)
 
+    def stop_timer(self):
+        '''Stop the timer without it firing.'''
+        self._deadline = None
+        if self._timer is not None:
+            self._timer.set_countdown(self._timer.NOT_RUNNING)
+
+    def set_timer(self, timer):
+        self._timer = timer
+        timer.set_debug(self._debug)
+
+    def get_timer(self):
+        return self._timer
+
+    def set_idle(self, idle):
+        '''An idle CPU executes no instructions: its clock keeps ticking
+        and it handles interrupts, until the OS gives it a process again.'''
+        self._idle = idle
+
+    def is_idle(self):
+        return self._idle
+
+    def clone(self, ram, os):
+        '''Return a copy of this CPU, attached to the given ram and os.
+        The CPU should not be running when it is cloned.'''
+        other = CPU(ram, os, self._num)
+        other.set_registers(self._registers)
+        other.set_mmu_registers(self._mmu.get_reloc_register(),
+                                self._mmu.get_limit_register())
+        other.set_text_segment(*self._mmu.get_text_registers())
+        other.set_stack_base(self._stack_base)
+        # The page table belongs to the current process: the OS's clone
+        # has its own copy.
+        curr = os.get_current_proc(self._num)
+        if curr is not None:
+            other.set_page_table(curr.get_page_table())
+        other.set_debug(self._debug)
+        other.set_clock_mode(self._clock_mode)
+        other.set_idle(self._idle)
+        other._cycles = self._cycles
+        return other
+
     def run_cpu(self):
         '''Run the CPU which repeatedly executes the instructions
         at the program counter (pc), until the "end" instruction is reached.
@@ -138,37 +251,64 @@ class CPU:
                 # No more processes to execute.
                 break
 
+            self.step()
+
+            if self._clock_mode == CLOCK_THREAD:
+                time.sleep(DELAY_BETWEEN_INSTRUCTIONS)
+
+    def run_slice(self, max_instrs):
+        '''Execute up to max_instrs instructions, stopping early if the
+        CPU is stopped.  Return the number of instructions executed.'''
+        count = 0
+        while count < max_instrs and not self._stop:
+            self.step()
+            count += 1
+        return count
+
+    def step(self):
+        '''Execute the instruction at the pc, then handle any interrupts
+        that have been raised.  An idle CPU just lets a cycle go by.'''
+        if self._idle:
+            self._cycles += 1
+        else:
             if self._debug:
                 # print(self._registers)
                 print("CPU {}: executing code at [{}]: {}".
-                      format(self._num, self._mmu.get_translated_addr(self._registers['pc']),
-                             self._mmu.get_val(self._registers['pc'])))
+                      format(self._num, self._mmu.get_translated_addr(self._registers[PC]),
+                             self._mmu.get_val(self._registers[PC])))
 
             # Execute the next instruction.
-            self.parse_instruction(self._mmu.get_val(self._registers['pc']))
+            self.parse_instruction(self._mmu.get_val(self._registers[PC]))
+            self._cycles += 1
 
             if self._debug:
                 print(self)
 
-            # Now, check if an interrupt has been raised.  If it has, run the
-            # corresponding handler.  Repeat until all interrupts have been serviced.
-            self.take_interrupt_mutex()
-            try:
-                if self._intr_raised:
-                    if self._debug: print("CPU {}: got interrupt".format(self._num))
-
-                    for addr in sorted(self._intr_addrs):
-                        # Call the interrupt handler.
-                        self._intr_vector[addr]()
-                        # Remove the device address from the list of pending interrupts.
-                        self._intr_addrs.remove(addr)
-                    
-                    # Mark all interrupts handled.
-                    self.set_interrupt(False)  # clear the interrupt
-            finally:
-                self.release_interrupt_mutex()
-            
-            time.sleep(DELAY_BETWEEN_INSTRUCTIONS)
+        if self._deadline is not None and self._cycles >= self._deadline:
+            # timer expired!  (CLOCK_CYCLES only.)
+            self._deadline = None
+            self.raise_interrupt(TIMER_DEV_ID)
+
+        self.service_interrupts()
+
+    def service_interrupts(self):
+        '''Check if an interrupt has been raised.  If it has, run the
+        corresponding handler.  Repeat until all interrupts have been serviced.'''
+        self.take_interrupt_mutex()
+        try:
+            if self._intr_raised:
+                if self._debug: print("CPU {}: got interrupt".format(self._num))
+
+                for addr in sorted(self._intr_addrs):
+                    # Call the interrupt handler.
+                    self._intr_vector[addr]()
+                    # Remove the device address from the list of pending interrupts.
+                    self._intr_addrs.remove(addr)
+                
+                # Mark all interrupts handled.
+                self.set_interrupt(False)  # clear the interrupt
+        finally:
+            self.release_interrupt_mutex()
 
 
     def parse_instruction(self, instr):
@@ -189,21 +329,54 @@ class CPU:
             src = words[1]
             dst = words[2]
 
-        if instr == "call":
+        if instr == "call" and (dst in REGISTER_INDEX or dst[0].isdigit()):
+            # call <addr> or call <reg>: call a subroutine, which returns
+            # with ret.
+            instr = "callsub"
+
+        if instr == "sys":
+            # System call by number.  The loader turns "call fname"
+            # into this, so the name does not have to be looked up
+            # every time.
+            self.handle_sys(dst)
+            self._registers[PC] += 1
+        elif instr == "call":
             # Call a python function.  Syntax is
             # call fname.  Function fname is a method in 
             # CalOS class and is called with the values in reg0, reg1, and reg2.
             self.handle_call(dst)
-            self._registers['pc'] += 1
+            self._registers[PC] += 1
+        elif instr == "callsub":
+            self.handle_callsub(dst)
+        elif instr == "ret":
+            self.handle_ret()
+        elif instr == "push":
+            self.handle_push(dst)
+            self._registers[PC] += 1
+        elif instr == "pop":
+            self.handle_pop(dst)
+            self._registers[PC] += 1
         elif instr == "mov":
             self.handle_mov(src, dst)
-            self._registers['pc'] += 1
+            self._registers[PC] += 1
         elif instr == 'add':
             self.handle_add(src, dst)
-            self._registers['pc'] += 1
+            self._registers[PC] += 1
         elif instr == 'sub':
             self.handle_sub(src, dst)
-            self._registers['pc'] += 1
+            self._registers[PC] += 1
+        elif instr == 'mul':
+            self.handle_mul(src, dst)
+            self._registers[PC] += 1
+        elif instr == 'div':
+            self.handle_div(src, dst)
+            self._registers[PC] += 1
+        elif instr == 'mod':
+            self.handle_mod(src, dst)
+            self._registers[PC] += 1
+        elif instr == 'cmp':
+            self.handle_cmp(src, dst)
+            self._registers[PC] += 1
         elif instr == 'jez':
             self.handle_jez(src, dst)
         elif instr == 'jnz':
@@ -224,69 +397,79 @@ class CPU:
     # TODO: do error checking in all these.
     # Could check for illegal addresses, etc.
     def handle_jmp(self, dst):
-        if self.isregister(dst):
-            self._registers['pc'] = self._registers[dst]
-        else:
-            self._registers['pc'] = eval(dst)
+        self._registers[PC] = self._get_jump_target(dst)
         
     def handle_jez(self, src, dst):
-        if not self.isregister(src):
+        idx = REGISTER_INDEX.get(src)
+        if idx is None:
             print("Illegal instruction")
             return
-        if self._registers[src] == 0:
-            if self.isregister(dst):
-                self._registers['pc'] = self._registers[dst]
-            else:
-                self._registers['pc'] = eval(dst)
+        if self._registers[idx] == 0:
+            self._registers[PC] = self._get_jump_target(dst)
         else:
-            self._registers['pc'] += 1
+            self._registers[PC] += 1
             
     def handle_jnz(self, src, dst):
-        if not self.isregister(src):
+        idx = REGISTER_INDEX.get(src)
+        if idx is None:
             print("Illegal instruction")
             return
-        if self._registers[src] != 0:
-            if self.isregister(dst):
-                self._registers['pc'] = self._registers[dst]
-            else:
-                self._registers['pc'] = eval(dst)
+        if self._registers[idx] != 0:
+            self._registers[PC] = self._get_jump_target(dst)
         else:
-            self._registers['pc'] += 1
+            self._registers[PC] += 1
             
     def handle_jlz(self, src, dst):
-        if not self.isregister(src):
+        idx = REGISTER_INDEX.get(src)
+        if idx is None:
             print("Illegal instruction")
             return
-        if self._registers[src] < 0:
-            if self.isregister(dst):
-                self._registers['pc'] = self._registers[dst]
-            else:
-                self._registers['pc'] = eval(dst)
+        if self._registers[idx] < 0:
+            self._registers[PC] = self._get_jump_target(dst)
         else:
-            self._registers['pc'] += 1
+            self._registers[PC] += 1
 
     def handle_jgz(self, src, dst):
-        if not self.isregister(src):
+        idx = REGISTER_INDEX.get(src)
+        if idx is None:
             print("Illegal instruction")
             return
-        if self._registers[src] > 0:
-            if self.isregister(dst):
-                self._registers['pc'] = self._registers[dst]
-            else:
-                self._registers['pc'] = eval(dst)
+        if self._registers[idx] > 0:
+            self._registers[PC] = self._get_jump_target(dst)
         else:
-            self._registers['pc'] += 1
+            self._registers[PC] += 1
+
+    def _get_jump_target(self, dst):
+        '''dst is a register name or an address.'''
+        idx = REGISTER_INDEX.get(dst)
+        if idx is not None:
+            return self._registers[idx]
+        return eval(dst)
+
+    def _get_addr(self, operand):
+        '''operand is "*<someval>", "*<reg>", or "*<reg>+<offset>" (or
+        -<offset>).  Return the logical address it refers to.  Values may
+        be decimal or hex.'''
+        ref = operand[1:]
+        idx = REGISTER_INDEX.get(ref)
+        if idx is not None:
+            return self._registers[idx]
+        for sign in '+-':
+            reg, _, offset = ref.partition(sign)
+            idx = REGISTER_INDEX.get(reg)
+            if idx is not None and offset != '':
+                return self._registers[idx] + eval(sign + offset)
+        return eval(ref)
 
     def _get_value_at(self, addr):
-        '''addr is "*<someval>".  return the value from
-        RAM at the addr, which might be decimal
-        or hex.'''
-        addr = eval(addr[1:])
-        return self._mmu.get_val(addr)
+        '''addr is "*<someval>", "*<reg>" or "*<reg>+<offset>".  return
+        the value from RAM at the address it refers to.'''
+        return self._mmu.get_val(self._get_addr(addr))
 
     def _get_srcval(self, src):
-        if self.isregister(src):
-            return self._registers[src]
+        idx = REGISTER_INDEX.get(src)
+        if idx is not None:
+            return self._registers[idx]
         elif src[0] == '*':
             return self._get_value_at(src)
         else:   # assume src holds a literal value
@@ -294,72 +477,149 @@ class CPU:
             # TODO: does the above handle putting strings in memory too?  It should
             # allow single characters, perhaps.
 
+    def _get_dst_addr(self, dst):
+        '''dst is a memory location: an address, or *<reg> or *<reg>+<offset>.
+        Return its logical address.'''
+        if dst[0] == '*':
+            return self._get_addr(dst)
+        return eval(dst)
 
     def handle_mov(self, src, dst):
         '''move value from a src to a dst.  src can be one of:
         literal value:          5
         value in memory:        *4
         value in register:      reg2
+        value in memory at reg (plus offset): *reg1, *reg1+2
         dst can be one of:
         memory location:        4
         register name:          reg1
-        memory location in reg: *reg1
+        memory location in reg (plus offset): *reg1, *reg1-1
         You cannot mov a value from RAM into RAM: you must use
         a register.
         '''
-        srcval = self._get_srcval(src)
+        self._store(dst, self._get_srcval(src))
 
-        if self.isregister(dst):
-            self._registers[dst] = srcval
-        elif dst[0] == '*':    # for *<register>
-            if self.isregister(dst[1:]):
-                self._mmu.set_val(self._registers[dst[1:]], srcval)
-            else:
-                print("Illegal instruction")
-                return
-        else:   # assume dst holds a literal value
-            self._mmu.set_val(eval(dst), srcval)
+    def _store(self, dst, val):
+        '''Store val in dst, a register name or a memory location.'''
+        idx = REGISTER_INDEX.get(dst)
+        if idx is not None:
+            self._registers[idx] = val
+        else:
+            self._mmu.set_val(self._get_dst_addr(dst), val)
 
-    def handle_add(self, src, dst):
+    def _handle_arith(self, src, dst, func):
+        '''Set dst to func(value of dst, value of src).  dst is as for mov.
+        Dividing by 0 generates a trap, and leaves dst alone.'''
         srcval = self._get_srcval(src)
 
-        if self.isregister(dst):
-            self._registers[dst] += srcval
-        elif dst[0] == '*':    # for *<register>
-            if self.isregister(dst[1:]):
-                currval = self._mmu.get_val(self._registers[dst[1:]])
-                self._mmu.set_val(self._registers[dst[1:]], currval + srcval)
+        idx = REGISTER_INDEX.get(dst)
+        try:
+            if idx is not None:
+                self._registers[idx] = func(self._registers[idx], srcval)
             else:
-                print("Illegal instruction")
-                return
-        else:   # assume dst holds a literal value
-            currval = self._mmu.get_val(eval(dst))
-            self._mmu.set_val(eval(dst), currval + srcval)
+                addr = self._get_dst_addr(dst)
+                self._mmu.set_val(addr, func(self._mmu.get_val(addr), srcval))
+        except ZeroDivisionError:
+            self._generate_trap(DIVIDE_BY_ZERO)
+
+    def handle_add(self, src, dst):
+        self._handle_arith(src, dst, operator.add)
 
     def handle_sub(self, src, dst):
+        self._handle_arith(src, dst, operator.sub)
+
+    def handle_mul(self, src, dst):
+        self._handle_arith(src, dst, operator.mul)
+
+    def handle_div(self, src, dst):
+        '''Divide dst by src, rounding down.'''
+        self._handle_arith(src, dst, operator.floordiv)
+
+    def handle_mod(self, src, dst):
+        '''Set dst to the remainder of dst divided by src, rounding
+        down: the remainder has the sign of src.'''
+        self._handle_arith(src, dst, operator.mod)
+
+    def handle_cmp(self, src, dst):
+        '''Set the flags register to -1, 0, or 1 as dst - src is negative,
+        0, or positive.  dst is not changed.'''
         srcval = self._get_srcval(src)
+        idx = REGISTER_INDEX.get(dst)
+        if idx is not None:
+            dstval = self._registers[idx]
+        else:
+            dstval = self._mmu.get_val(self._get_dst_addr(dst))
+        self._registers[FLAGS] = (dstval > srcval) - (dstval < srcval)
 
-        if self.isregister(dst):
-            self._registers[dst] -= srcval
-        elif dst[0] == '*':    # for *<register>
-            if self.isregister(dst[1:]):
-                currval = self._mmu.get_val(self._registers[dst[1:]])
-                self._mmu.set_val(self._registers[dst[1:]], currval - srcval)
-            else:
-                print("Illegal instruction")
-                return
-        else:   # assume dst holds a literal value
-            currval = self._mmu.get_val(eval(dst))
-            self._mmu.set_val(eval(dst), currval - srcval)
+    def handle_push(self, src):
+        '''Push the value of src onto the stack.'''
+        self._push(self._get_srcval(src))
+
+    def handle_pop(self, dst):
+        '''Pop the value on top of the stack into dst (as for mov).'''
+        if self._stack_is_empty():
+            return
+        val = self._mmu.get_val(self._registers[SP])
+        self._registers[SP] += 1
+        self._store(dst, val)
+
+    def handle_callsub(self, dst):
+        '''Push the address of the next instruction, and jump to dst.'''
+        target = self._get_jump_target(dst)
+        if self._push(self._registers[PC] + 1):
+            self._registers[PC] = target
+
+    def handle_ret(self):
+        '''Pop the return address pushed by call into the pc.'''
+        if self._stack_is_empty():
+            return
+        self._registers[PC] = self._mmu.get_val(self._registers[SP])
+        self._registers[SP] += 1
+
+    def _push(self, val):
+        '''Push val.  If the stack is full -- sp is at the stack base --
+        generate a trap instead, and return False.'''
+        sp = self._registers[SP] - 1
+        if sp < self._stack_base:
+            print("ERROR: stack overflow")
+            self._generate_trap(ILLEGAL_ADDRESS)
+            return False
+        self._mmu.set_val(sp, val)
+        self._registers[SP] = sp
+        return True
+
+    def _stack_is_empty(self):
+        '''Return True, and generate a trap, if there is nothing on the
+        stack to pop: sp is at (or past) the MMU limit.'''
+        if self._registers[SP] >= self._mmu.get_limit_register():
+            print("ERROR: stack underflow")
+            self._generate_trap(ILLEGAL_ADDRESS)
+            return True
+        return False
 
     def handle_call(self, fname):
-        self._os.syscall(fname, self._reg0, self._reg1, self._reg2)
+        num = self._os.get_syscall_num(fname)
+        if num is None:
+            print("ERROR: unknown system call", fname)
+            return
+        self._do_syscall(num)
+
+    def handle_sys(self, num):
+        self._do_syscall(int(num))
+
+    def _do_syscall(self, num):
+        '''Call system call num with the values in reg0, reg1 and reg2.
+        The result, if any, goes in reg0.'''
+        res = self._os.syscall(self, num, self._registers[REG0],
+                               self._registers[REG1], self._registers[REG2])
+        if res is not None:
+            self._registers[REG0] = res
 
     def _generate_trap(self, reason):
         """Generate a software interrupt -- aka a trap.
         Store the reason for the trap in register 0."""
         
-        self._registers['reg0'] = reason
+        self._registers[REG0] = reason
         self.take_interrupt_mutex()
         self.add_interrupt_addr(SOFTWARE_TRAP_DEV_ID)
         self.set_interrupt(True)
@@ -373,13 +633,52 @@ class CPU:
         '''Software interrupt handler.  Pass control to the OS.
         The reason for the software trap is found in register 0, so
         pass that also as a parameter to the OS handler.'''
-        self._os.trap_isr(self, self._registers['reg0'])
+        self._os.trap_isr(self, self._registers[REG0])
+
+    def _yield_isr(self):
+        '''The current process is waiting for a device.  Pass control to the OS.'''
+        self._os.yield_isr(self)
+
+    def _tty_isr(self):
+        '''The tty has finished a read.  Pass control to the OS.'''
+        self._os.tty_isr(self)
+
+    def _page_fault_isr(self, page):
+        '''Page fault handler, called by the MMU before it completes an
+        access to a page that is not present.  Pass control to the OS.'''
+        self._os.page_fault_isr(self, page)
+
+    def _protection_fault_isr(self, addr):
+        '''Called by the MMU when the process writes to its code, which is
+        read-only: end the process.'''
+        self._generate_trap(ILLEGAL_ADDRESS)
+
+    def get_mmu(self):
+        return self._mmu
+
+    def set_page_table(self, page_table):
+        """Set the list of page present flags the mmu checks, or None
+        to turn demand paging off."""
+        self._mmu.set_page_table(page_table)
 
     def set_mmu_registers(self, reloc, limit):
         """Set the mmu to offset logical address."""
         self._mmu.set_reloc_register(reloc)
         self._mmu.set_limit_register(limit)
 
+    def set_stack_base(self, base):
+        """Set the logical address of the bottom of the stack: a push
+        that would put sp below it is a stack overflow."""
+        self._stack_base = max(base, 0)
+
+    def get_stack_base(self):
+        return self._stack_base
+
+    def set_text_segment(self, base, size):
+        """Make logical addresses 0 to size - 1 the read-only code at
+        physical address base.  A size of 0 means there is no text segment."""
+        self._mmu.set_text_registers(base, size)
+
     def set_stop_cpu(self, val):
         """Call this to stop the CPU because there are no more processes
         to execute."""
@@ -1,8 +1,16 @@
 '''Devices that interact with the CPU: I/O ports, timer, etc.'''
 
+import asyncio
+import queue
+import sys
 import threading
 import time
 
+# Names of the devices a machine can be configured with (see config.py).
+# Every machine has a timer.
+TTY = "tty"
+DEVICE_NAMES = (TTY,)
+
 class TimerController(threading.Thread):
     '''This controller controls a timer device that interrupts the
     CPU whenever the timer runs down to 0.  A countdown value of -1
@@ -13,15 +21,18 @@ class TimerController(threading.Thread):
     NOT_RUNNING = -1
 
     def __init__(self, cpu, dev_id, debug=False):
-        threading.Thread.__init__(self)
+        # A daemon, so that a timer that is not running does not keep
+        # the program from ending.
+        threading.Thread.__init__(self, daemon=True)
         self._cpu = cpu
 
         # Bus address identifier: used to indicate to the CPU
         # what device has raised an interrupt.
         self._dev_id = dev_id
         self._countdown = self.NOT_RUNNING
-        # mutex lock to protect setting/getting the countdown.
-        self._mutex = threading.Lock()
+        # Protects setting/getting the countdown, and is notified when
+        # the countdown is set.
+        self._cond = threading.Condition()
 
         self._debug = debug
         if self._debug: print("TimerController created!")
@@ -29,43 +40,170 @@ class TimerController(threading.Thread):
     def set_countdown(self, val):
         '''Set the number of cycles until the timer fires.
         '''
-        with self._mutex:
+        with self._cond:
             self._countdown = val
-        if self._debug: print("Timer: set countdown to", self._countdown)
+            self._cond.notify()
+        if self._debug: print("Timer: set countdown to", val)
 
     def set_debug(self, debug):
         self._debug = debug
 
     def run(self):
         '''When running, count down from _countdown to 0, and then
-        raise an interrupt.  When not running, periodically see if
-        the countdown value has been set -- enabling the timer again.
+        raise an interrupt.  When not running, sleep until the countdown
+        value is set -- enabling the timer again -- so that a stopped
+        timer costs no host CPU time.
         countdown value of -1 indicates the timer is not running.
         '''
 
         if self._debug: print("TimerController: running!")
         while True:
-            # Copy value to local variable
-            with self._mutex:
-                countdown = self._countdown
-                
-            if countdown > 0:
-                countdown -= 1
-            if countdown == 0:
+            with self._cond:
+                while self._countdown == self.NOT_RUNNING:
+                    self._cond.wait()
+                if self._countdown > 0:
+                    self._countdown -= 1
+                expired = self._countdown == 0
+                if expired:
+                    # Don't generate another interrupt until the
+                    # previous one is handled and the timer is reset.
+                    self._countdown = self.NOT_RUNNING
+
+            if expired:
                 # timer expired!
-                self._cpu.take_interrupt_mutex()
-                self._cpu.add_interrupt_addr(self._dev_id)
-                self._cpu.set_interrupt(True)
-                self._cpu.release_interrupt_mutex()
-                # Don't generate another interrupt until the
-                # previous one is handled and the interrupt is
-                # reset.
-                countdown = self.NOT_RUNNING
-            else:    # countdown < 0: indicating do nothing.
-                pass
-
-            with self._mutex:
-                self._countdown = countdown
+                self._cpu.raise_interrupt(self._dev_id)
 
             time.sleep(self.DELAY)
 
+
+class IORequest:
+    '''A request to a device to read count words into the memory of the
+    process pcb, starting at logical address addr.  The device stores
+    the words it read with set_words(): fewer than count if the input
+    ended.'''
+
+    def __init__(self, pcb, addr, count):
+        self._pcb = pcb
+        self._addr = addr
+        self._count = count
+        self._words = None
+
+    def get_pcb(self):
+        return self._pcb
+
+    def get_addr(self):
+        return self._addr
+
+    def get_count(self):
+        return self._count
+
+    def set_words(self, words):
+        self._words = words
+
+    def get_words(self):
+        return self._words
+
+
+class TTYController(threading.Thread):
+    '''This controller reads the keyboard for the ttyread system call,
+    in its own thread, so that the CPUs can run other processes while a
+    process waits for input.  Requests are served in the order they are
+    made: when a request has all its words, done(request) is called.
+    '''
+
+    def __init__(self, debug=False):
+        # A daemon, because it may be stuck in input() when the program ends.
+        threading.Thread.__init__(self, daemon=True)
+        self._requests = queue.Queue()
+        # Words read but not yet given to a request.
+        self._words = []
+        self._eof = False
+        self._debug = debug
+
+    def request_read(self, request, done):
+        self._requests.put((request, done))
+
+    def run(self):
+        while True:
+            request, done = self._requests.get()
+            count = request.get_count()
+            try:
+                while len(self._words) < count and not self._eof:
+                    self._words.extend(input().split())
+            except EOFError:
+                self._eof = True
+            request.set_words(self._words[:count])
+            del self._words[:count]
+            if self._debug: print("TTYController: read", request.get_words())
+            done(request)
+
+
+class AsyncTTY:
+    '''The terminal used by the asyncio kernel (CalOS.run_async()).
+    Input is read from an asyncio.StreamReader -- by default, one
+    connected to standard input, opened the first time input is needed --
+    and split into words.  Output is written to an asyncio.StreamWriter,
+    or to standard output if there is none.
+    '''
+
+    def __init__(self, reader=None, writer=None):
+        self._reader = reader
+        self._writer = writer
+        self._words = []
+        self._eof = False
+        # Requests are served one at a time, in order.
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    def request_read(self, request, done):
+        '''Like TTYController.request_read(), but the read is a task in
+        the running event loop.'''
+        task = asyncio.get_running_loop().create_task(self._read(request, done))
+        # The loop only keeps a weak reference to its tasks.
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _read(self, request, done):
+        async with self._lock:
+            await self.fill(request.get_count())
+            request.set_words(self.take_words(request.get_count()))
+        done(request)
+
+    def take_words(self, count):
+        '''Remove and return the next count input words, if that many
+        have been read.  Return None if the caller must wait for fill().
+        At the end of the input, return whatever words are left.'''
+        if len(self._words) < count and not self._eof:
+            return None
+        words = self._words[:count]
+        del self._words[:count]
+        return words
+
+    async def fill(self, count):
+        '''Read input until count words are available, or the input ends.'''
+        if self._reader is None:
+            self._reader = await _open_stdin()
+        while len(self._words) < count:
+            line = await self._reader.readline()
+            if not line:
+                self._eof = True
+                return
+            self._words.extend(line.decode().split())
+
+    def write_line(self, text):
+        if self._writer is None:
+            sys.stdout.write(text + "\n")
+        else:
+            self._writer.write((text + "\n").encode())
+
+    async def drain(self):
+        '''Wait until the output written so far has been sent.'''
+        if self._writer is not None:
+            await self._writer.drain()
+
+
+async def _open_stdin():
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    return reader
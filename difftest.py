@@ -0,0 +1,367 @@
+'''Check that an alternative execution engine runs programs exactly the
+way the CPU does.
+
+random_program() makes a random program out of the instructions that
+CPU and the alternative engine both implement: arithmetic, jumps, the
+stack, and every kind of operand.  check_program() runs a program on
+several lanes of the engine, each with its own random data, and on the
+reference -- a CPU executing the same program with the same data, lane
+by lane.  It compares the registers, the data and stack words, and the
+trap reasons of each lane after every block of instructions, so that a
+difference is reported close to the instruction that caused it.
+
+The engine is anything with BatchMachine's interface: make_engine(ram,
+pcb, num_lanes) must return an object with set_word(), run(max_steps),
+get_registers(), get_status() and get_words().
+
+Some programs do things whose effect on the CPU is not defined, and
+which an engine need not copy (see batch.py):
+o using an address outside the process's memory (the CPU only prints a
+  warning): the engine must stop the lane, with any trap reason,
+o using a word that holds an instruction as a number, or changing the
+  program's code, and
+o making a value that does not fit in 64 bits.
+Lanes are only compared up to the point where this happens.
+
+Typical use:
+    python difftest.py [<number of programs> [<seed>]]
+'''
+
+import contextlib
+import io
+import random
+import sys
+
+import batch
+import calos
+from cpu import CPU, CLOCK_EXTERNAL, REGISTER_INDEX, SP
+from ram import RAM
+
+DEFAULT_PROGRAM_SIZE = 24
+DEFAULT_DATA_SIZE = 16
+DEFAULT_STACK_SIZE = 8
+DEFAULT_LANES = 16
+# Instructions each lane executes between comparisons, and in all.
+DEFAULT_BLOCK_SIZE = 8
+DEFAULT_MAX_STEPS = 400
+
+# Registers compared after each block.  pc is only compared while a lane
+# is running: the CPU moves pc past some instructions that trap.
+COMPARED_REGISTERS = ('reg0', 'reg1', 'reg2', 'flags', 'sp')
+
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+# Registers the generator uses.  sp is used less often than the others,
+# as changing it makes the stack instructions trap.
+_GENERAL_REGISTERS = ('reg0', 'reg1', 'reg2', 'flags')
+_ARITHMETIC = ('mov', 'add', 'sub', 'mul', 'div', 'mod', 'cmp')
+_CONDITIONAL_JUMPS = ('jez', 'jnz', 'jgz', 'jlz')
+
+
+def random_program(rng, num_instrs=DEFAULT_PROGRAM_SIZE, data_size=DEFAULT_DATA_SIZE):
+    '''Return a random program of num_instrs instructions, ending with
+    end.  It is to be loaded right after data_size words of data, which
+    start at address 0: then the small numbers the program computes are
+    mostly data addresses.'''
+    gen = _Generator(rng, num_instrs, data_size)
+    return [gen.instruction() for _ in range(num_instrs - 1)] + ['end']
+
+
+def random_inputs(rng, num_lanes, data_size=DEFAULT_DATA_SIZE):
+    '''Return a list with the data words for each lane.  Most are data
+    addresses, so that the program can use them as pointers.'''
+    return [[rng.randint(-4, data_size - 1) for _ in range(data_size)] for _ in range(num_lanes)]
+
+
+class _Generator:
+
+    def __init__(self, rng, num_instrs, data_size):
+        self._rng = rng
+        self._code = range(data_size, data_size + num_instrs)
+        self._data = range(data_size)
+
+    def instruction(self):
+        rng = self._rng
+        kind = rng.random()
+        if kind < 0.45:
+            op = rng.choice(_ARITHMETIC)
+            if (op == 'div' or op == 'mod') and rng.random() < 0.7:
+                # Registers start at 0: dividing by them mostly traps.
+                src = str(rng.choice((-3, -2, 2, 3, 5)))
+            else:
+                src = self._operand(memory=True)
+            # At most one operand may be in memory.
+            dst = self._operand(memory=src[0] != '*', literal=False)
+            return "{} {} {}".format(op, src, dst)
+        if kind < 0.55:
+            # Point a register at the data, for *<reg>+<offset> operands.
+            return "mov {} {}".format(rng.choice(self._data), self._register())
+        if kind < 0.7:
+            return "{} {} {}".format(rng.choice(_CONDITIONAL_JUMPS), self._register(),
+                                     self._target())
+        if kind < 0.75:
+            return "jmp {}".format(self._target())
+        # Popping an empty stack traps, so there are more pushes than pops.
+        if kind < 0.84:
+            return "push {}".format(self._operand(memory=True))
+        if kind < 0.88:
+            return "pop {}".format(self._operand(memory=True, literal=False))
+        if kind < 0.95:
+            return "call {}".format(self._target())
+        if kind < 0.98:
+            return "ret"
+        return "end"
+
+    def _register(self):
+        if self._rng.random() < 0.05:
+            return 'sp'
+        return self._rng.choice(_GENERAL_REGISTERS)
+
+    def _operand(self, memory, literal=True):
+        '''Return a register, a memory operand (if memory is True), or a
+        number: a small literal if literal is True, and otherwise a data
+        address, which is a memory location when used as a destination.'''
+        rng = self._rng
+        kind = rng.random()
+        if kind < 0.5 or (not memory and not literal):
+            return self._register()
+        if kind < 0.7 or not memory:
+            val = rng.randint(-9, 9) if literal else rng.choice(self._data)
+            return hex(val) if rng.random() < 0.2 else str(val)
+        if kind < 0.85:
+            return "*{}".format(rng.choice(self._data))
+        offset = rng.randint(-1, 3)
+        if offset == 0:
+            return "*{}".format(self._register())
+        return "*{}{:+d}".format(self._register(), offset)
+
+    def _target(self):
+        if self._rng.random() < 0.05:
+            return self._register()
+        return str(self._rng.choice(self._code))
+
+
+class Result:
+    '''What check_program() found.'''
+
+    def __init__(self):
+        self._mismatches = []
+        self._undefined = {}
+        self._steps = 0
+
+    def get_mismatches(self):
+        '''Return a list of (lane, step, description) for each lane that
+        the engine ran differently from the reference.'''
+        return self._mismatches
+
+    def get_undefined(self):
+        '''Return a dictionary mapping lane to the reason the rest of its
+        run was not compared.'''
+        return self._undefined
+
+    def get_steps(self):
+        '''Return the number of steps the lanes were run for.'''
+        return self._steps
+
+
+class _Reference:
+    '''One lane of the reference: a CPU running the program in a RAM of
+    its own, the size of the process's memory.  It is its own OS: it
+    only has to handle the trap that ends the program.'''
+
+    def __init__(self, words, code_start, code_end):
+        size = len(words)
+        self._code_start = code_start
+        self._code_end = code_end
+        self._code = words[code_start:code_end]
+        self._ram = RAM(size)
+        self._ram.write_block(0, words)
+        self._cpu = CPU(self._ram, self)
+        self._cpu.set_clock_mode(CLOCK_EXTERNAL)
+        self._cpu.set_mmu_registers(0, size)
+        self._cpu.set_stack_base(code_end)
+        self._cpu.set_pc(code_start)
+        self._cpu.get_registers()[SP] = size
+        # The reason the program trapped, once it has.
+        self._trap = None
+        # Why the rest of the run is not defined, if it is not.
+        self._undefined = None
+        self._out_of_range = False
+
+    def trap_isr(self, cpu, reason):
+        self._trap = reason
+        cpu.set_stop_cpu(True)
+
+    def get_trap(self):
+        return self._trap
+
+    def get_undefined(self):
+        return self._undefined
+
+    def is_out_of_range(self):
+        return self._out_of_range
+
+    def get_registers(self):
+        return self._cpu.get_registers()
+
+    def get_data(self):
+        '''Return the words that are not code: the data and the stack.'''
+        return (self._ram.read_block(0, self._code_start) +
+                self._ram.read_block(self._code_end, self._ram.get_size() - self._code_end))
+
+    def run(self, steps):
+        '''Execute up to steps instructions, stopping early if the program
+        ends or does something that is not defined.'''
+        for _ in range(steps):
+            if self._trap is not None or self._undefined is not None:
+                return
+            try:
+                self._cpu.step()
+            except AssertionError:
+                # RAM checks that addresses are legal.
+                self._undefined = "used an address outside its memory"
+                self._out_of_range = True
+                return
+            except TypeError:
+                self._undefined = "used an instruction as a number"
+                return
+            self._check_defined()
+
+    def _check_defined(self):
+        for val in self._cpu.get_registers():
+            if not _is_word(val):
+                self._undefined = "made a value that is not a 64 bit number"
+                return
+        if self._ram.read_block(self._code_start, len(self._code)) != self._code:
+            self._undefined = "changed its code"
+            return
+        for val in self.get_data():
+            if not _is_word(val):
+                self._undefined = "made a value that is not a 64 bit number"
+                return
+
+
+def _is_word(val):
+    return isinstance(val, int) and INT64_MIN <= val <= INT64_MAX
+
+
+def check_program(program, inputs, make_engine=batch.BatchMachine,
+                  stack_size=DEFAULT_STACK_SIZE, block_size=DEFAULT_BLOCK_SIZE,
+                  max_steps=DEFAULT_MAX_STEPS):
+    '''Run program (a list of instructions) on one engine lane, and one
+    reference CPU, per list of data words in inputs.  The data is loaded
+    at address 0, the program right after it, and stack_size words of
+    stack after the program.  Compare the lanes after every block_size
+    steps, for at most max_steps steps.  Return a Result.'''
+    num_lanes = len(inputs)
+    code_start = len(inputs[0])
+    code_end = code_start + len(program)
+    size = code_end + stack_size
+    image = [0] * code_start + list(program) + [0] * stack_size
+
+    ram = RAM(size)
+    ram.write_block(0, image)
+    pcb = calos.PCB("difftest")
+    pcb.set_low_mem(0)
+    pcb.set_high_mem(size)
+    pcb.set_stack_base(code_end)
+    pcb.set_entry_point(code_start)
+    engine = make_engine(ram, pcb, num_lanes)
+    refs = []
+    for data in inputs:
+        refs.append(_Reference(list(data) + image[code_start:], code_start, code_end))
+    for addr in range(code_start):
+        engine.set_word(addr, [data[addr] for data in inputs])
+
+    result = Result()
+    # Lanes still being compared.
+    lanes = set(range(num_lanes))
+    # The words compared: all but the code.
+    addrs = list(range(code_start)) + list(range(code_end, size))
+    # The CPU prints a message for each trap and bad address.
+    with contextlib.redirect_stdout(io.StringIO()):
+        while lanes and result._steps < max_steps:
+            steps = min(block_size, max_steps - result._steps)
+            engine.run(steps)
+            for lane in lanes:
+                refs[lane].run(steps)
+            result._steps += steps
+            _compare(engine, refs, lanes, result, addrs)
+            if all(refs[lane].get_trap() is not None for lane in lanes):
+                break
+    return result
+
+
+def _compare(engine, refs, lanes, result, addrs):
+    '''Compare the given lanes of engine with the reference, looking at
+    the words at addrs.  Lanes that differ, or whose run is no longer
+    defined, are removed from lanes.'''
+    registers = engine.get_registers()
+    status = engine.get_status()
+    words = engine.get_words(0, addrs[-1] + 1)[:, addrs]
+    for lane in sorted(lanes):
+        ref = refs[lane]
+        problem = None
+        if ref.get_undefined() is not None:
+            if ref.is_out_of_range() and status[lane] == batch.RUNNING:
+                problem = "the reference {}, but the engine did not stop".format(
+                    ref.get_undefined())
+            else:
+                result._undefined[lane] = ref.get_undefined()
+        elif ref.get_trap() is None and status[lane] != batch.RUNNING:
+            problem = "the engine trapped with reason {}, the reference did not trap".format(
+                status[lane])
+        elif ref.get_trap() is not None and status[lane] == batch.RUNNING:
+            problem = "the reference trapped with reason {}, the engine did not trap".format(
+                ref.get_trap())
+        elif ref.get_trap() is not None and status[lane] != ref.get_trap():
+            problem = "trap reason is {} on the reference, {} on the engine".format(
+                ref.get_trap(), status[lane])
+        else:
+            names = COMPARED_REGISTERS if ref.get_trap() is not None else COMPARED_REGISTERS + ('pc',)
+            for name in names:
+                ref_val = ref.get_registers()[REGISTER_INDEX[name]]
+                if ref_val != registers[name][lane]:
+                    problem = "{} is {} on the reference, {} on the engine".format(
+                        name, ref_val, registers[name][lane])
+                    break
+            else:
+                for idx, ref_val in enumerate(ref.get_data()):
+                    if ref_val != words[lane][idx]:
+                        problem = "word {} is {} on the reference, {} on the engine".format(
+                            addrs[idx], ref_val, words[lane][idx])
+                        break
+        if problem is not None:
+            result._mismatches.append((lane, result._steps, problem))
+        if problem is not None or ref.get_undefined() is not None:
+            lanes.discard(lane)
+
+
+def main(num_programs, seed):
+    '''Check num_programs random programs against BatchMachine.  Print
+    each program that runs differently, and return the number of them.'''
+    rng = random.Random(seed)
+    failed = 0
+    compared = undefined = 0
+    for num in range(num_programs):
+        program = random_program(rng)
+        inputs = random_inputs(rng, DEFAULT_LANES)
+        result = check_program(program, inputs)
+        undefined += len(result.get_undefined())
+        compared += DEFAULT_LANES - len(result.get_undefined())
+        if result.get_mismatches():
+            failed += 1
+            print("Program {} runs differently:".format(num))
+            for addr, instr in enumerate(program, DEFAULT_DATA_SIZE):
+                print("  {:3d}: {}".format(addr, instr))
+            for lane, step, problem in result.get_mismatches():
+                print("  lane {} (data {}), by step {}: {}".format(lane, inputs[lane], step, problem))
+    print("{} programs, {} lanes compared to the end, {} partly undefined: {} programs ran differently".
+          format(num_programs, compared, undefined, failed))
+    return failed
+
+
+if __name__ == "__main__":
+    num_programs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    sys.exit(1 if main(num_programs, seed) else 0)
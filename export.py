@@ -0,0 +1,138 @@
+'''Stream a range of RAM to the screen or to a file.
+
+RAM is read and formatted a chunk at a time, so memory use does not grow
+with the size of the range, and each chunk is written with one call.
+
+Formats:
+text     the monitor's listing: one "[addr] value" line per word
+tape     one value per line: can be loaded back with the L command
+csv      "address,value" lines, after a header line
+binary   a header (MAGIC, then the start address and word count as
+         64-bit little-endian integers) followed by one record per word:
+         b'i' and a 64-bit little-endian integer, or b's' (string) or
+         b'I' (integer too big for 64 bits) followed by the length of its
+         UTF-8 text as a 32-bit little-endian integer, and the text.
+Any format can be written gzip-compressed.
+'''
+
+import csv
+import gzip
+import io
+import struct
+import sys
+
+# Number of words read and formatted at a time.
+CHUNK_SIZE = 4096
+
+MAGIC = b'CALOSRAM'
+
+FORMATS = ('text', 'tape', 'csv', 'binary')
+
+# File name extensions that select a format.
+_EXTENSIONS = { '.csv': 'csv', '.bin': 'binary' }
+
+_INT64 = struct.Struct('<q')
+_LEN = struct.Struct('<I')
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def iter_chunks(ram, start, end, chunk_size=CHUNK_SIZE):
+    '''Yield (addr, vals) for consecutive chunks of ram from start
+    to end, inclusive: vals is a list of the words starting at addr.'''
+    addr = start
+    while addr <= end:
+        count = min(chunk_size, end - addr + 1)
+        yield addr, ram.read_block(addr, count)
+        addr += count
+
+
+def format_text(addr, vals):
+    lines = []
+    for val in vals:
+        if isinstance(val, int):
+            lines.append("[%04d] %d\n" % (addr, val))
+        else:
+            lines.append("[%04d] %s\n" % (addr, val))
+        addr += 1
+    return "".join(lines)
+
+
+def format_tape(addr, vals):
+    return "".join(str(val) + "\n" for val in vals)
+
+
+def format_csv(addr, vals):
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\n").writerows(
+        (addr + i, val) for i, val in enumerate(vals))
+    return buf.getvalue()
+
+
+def format_binary(addr, vals):
+    records = []
+    for val in vals:
+        if isinstance(val, int) and _INT64_MIN <= val <= _INT64_MAX:
+            records.append(b'i' + _INT64.pack(val))
+        else:
+            text = str(val).encode('utf-8')
+            tag = b'I' if isinstance(val, int) else b's'
+            records.append(tag + _LEN.pack(len(text)) + text)
+    return b"".join(records)
+
+
+_FORMATTERS = {
+    'text': format_text,
+    'tape': format_tape,
+    'csv': format_csv,
+    'binary': format_binary,
+}
+
+
+def write_ram(ram, start, end, out, fmt='text', chunk_size=CHUNK_SIZE):
+    '''Write the words of ram from start to end, inclusive, to the open
+    file out in format fmt.  out must be opened in binary mode for the
+    binary format, and in text mode for the others.'''
+    formatter = _FORMATTERS[fmt]
+    if fmt == 'binary':
+        out.write(MAGIC + _INT64.pack(start) + _INT64.pack(end - start + 1))
+    elif fmt == 'csv':
+        out.write("address,value\n")
+    for addr, vals in iter_chunks(ram, start, end, chunk_size):
+        out.write(formatter(addr, vals))
+
+
+def export_ram(ram, start, end, filename, fmt=None, compress=None):
+    '''Write the words of ram from start to end, inclusive, to the file
+    filename.  If fmt is None, it is taken from the file name's extension:
+    .csv for csv, .bin for binary, and tape otherwise.  If compress is
+    None, the file is gzip-compressed if its name ends in .gz.'''
+    name = filename.lower()
+    if compress is None:
+        compress = name.endswith('.gz')
+    if name.endswith('.gz'):
+        name = name[:-len('.gz')]
+    if fmt is None:
+        fmt = 'tape'
+        for ext in _EXTENSIONS:
+            if name.endswith(ext):
+                fmt = _EXTENSIONS[ext]
+    if fmt not in FORMATS:
+        raise ValueError("Unknown format: " + fmt)
+
+    mode = 'wb' if fmt == 'binary' else 'wt'
+    if compress:
+        f = gzip.open(filename, mode)
+    elif fmt == 'binary':
+        f = open(filename, mode)
+    else:
+        f = open(filename, mode, newline='')
+    with f:
+        write_ram(ram, start, end, f, fmt)
+
+
+def dump_ram(ram, start, end, out=None):
+    '''Show the words of ram from start to end, inclusive, in the
+    monitor's listing format.'''
+    if out is None:
+        out = sys.stdout
+    write_ram(ram, start, end, out, 'text')
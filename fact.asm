@@ -0,0 +1,24 @@
+# Compute the factorial of the number in location 13, leaving the result
+# in location 14, with a recursive subroutine: call and ret, with the
+# argument saved on the stack by push and pop.  Each level of recursion
+# takes 2 words of stack: a number too big for the process's stack ends
+# the program with a stack overflow, leaving location 14 alone.
+# Note: all addresses are logical
+__main: 0
+mov *13 reg0
+call 4
+mov reg1 14
+end
+# fact: location 4.  Leave the factorial of reg0 in reg1.
+jgz reg0 7
+mov 1 reg1
+ret
+# location 7: reg1 = reg0 * fact(reg0 - 1)
+push reg0
+sub 1 reg0
+call 4
+pop reg0
+mul reg0 reg1
+ret
+# Need space for 2 values: the number and the result.
+__data: 2
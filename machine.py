@@ -0,0 +1,63 @@
+'''A machine: the RAM, the OS and the CPUs that run on it.'''
+
+import calos
+from config import DEFAULT_NUM_CPUS
+from cpu import CPU
+from ram import RAM
+
+
+class Machine:
+
+    def __init__(self, ram=None, num_cpus=DEFAULT_NUM_CPUS, debug=False):
+        if ram is None:
+            ram = RAM()
+        self._ram = ram
+        self._os = calos.CalOS(ram, debug)
+        self._cpus = [CPU(ram, self._os, num) for num in range(num_cpus)]
+        self._os.set_cpus(self._cpus)
+
+    def get_ram(self):
+        return self._ram
+
+    def get_os(self):
+        return self._os
+
+    def get_cpus(self):
+        return self._cpus
+
+    def run(self):
+        '''Run the processes in the OS's ready queue to completion.'''
+        self._os.run()
+
+    async def run_async(self, tty=None):
+        '''Like run(), but as a coroutine, using no threads: see
+        CalOS.run_async().'''
+        await self._os.run_async(tty)
+
+    def clone(self):
+        '''Return a copy of this machine: RAM, OS (ready queue and PCBs)
+        and CPU registers.  The RAM is shared copy-on-write, so cloning
+        is cheap however much has been loaded into it, and each clone
+        only pays for the pages it writes.  The machine should not be
+        running when it is cloned.
+
+        Typical use: load calos.asm and a program once, then clone the
+        machine for each variant and poke the input words into the clone.
+        '''
+        other = Machine.__new__(Machine)
+        other._ram = self._ram.clone()
+        other._os = self._os.clone(other._ram)
+        other._cpus = [cpu.clone(other._ram, other._os) for cpu in self._cpus]
+        other._os.set_cpus(other._cpus)
+        return other
+
+
+def build_machine(config):
+    '''Build the machine described by config, a config.MachineConfig.
+    Nothing is started yet: the OS starts the threads and devices that
+    a run needs when it runs.'''
+    machine = Machine(RAM(config.get_ram_size()), config.get_num_cpus(), config.get_debug())
+    for cpu in machine.get_cpus():
+        cpu.set_clock_mode(config.get_clock_mode())
+    machine.get_os().set_devices(config.get_device_names())
+    return machine
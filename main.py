@@ -1,14 +1,35 @@
+import sys
+
 import calos
-from cpu import CPU, MAX_CHARS_PER_ADDR
-from ram import RAM
+import config
+from cpu import MAX_CHARS_PER_ADDR
+import export
+import manifest
+from machine import build_machine
+import tape
 
 
 '''
 Architecture Description:
-There are 3 registers, reg0, reg1, reg2, and a program counter
-register, pc.
+There are 3 registers, reg0, reg1, reg2, a program counter
+register, pc, a flags register, flags, set by cmp, and a stack
+pointer, sp.
+
+Each process gets a stack of calos.STACK_SIZE words above its code
+and data, at the top of its memory.  The stack grows down: sp holds
+the address of the word on top, and starts at the process's memory
+limit (an empty stack).  Pushing onto a full stack -- one that holds
+calos.STACK_SIZE words, so that the next push would overwrite the
+process's data -- or popping an empty one, ends the program with a bad
+address trap.
+
+Processes loaded with "L <tapename>" share one read-only copy of the
+code at the start of the tape (up to its first data value) with the
+other processes running the same code.  Writing to it ends the
+program with a bad address trap.
 
-There are 1024 words of RAM, from addresses 0 to 1023.  The number
+There are 1024 words of RAM, from addresses 0 to 1023, unless the
+machine description (see config.py) says otherwise.  The number
 of bits/bytes in a word is not defined:
 o Any positive or negative number fits in a word.
 o Every instruction, including arguments, fits in a word.
@@ -20,22 +41,53 @@ Assembly Language Instructions:
 mov <src> <dst>   move value from <src> to <dst>
 add <val> <dst>   add value to <dst>
 sub <val> <dst>   sub value from <dst>
+mul <val> <dst>   multiply <dst> by value
+div <val> <dst>   divide <dst> by value, rounding down
+mod <val> <dst>   set <dst> to the remainder of dividing it by value
+cmp <val> <dst>   set flags to 1, 0 or -1 as <dst> is >, == or < value
 
 <src> and <dst> can be a register name, a <value>, or *<value>.
 *<src> means the contents of RAM at the address <src>.
 *<reg> means the contents of RAM at the location referenced by reg.
+*<reg>+<n> and *<reg>-<n> mean the contents of RAM at reg + n, reg - n.
 You cannot move values from one RAM location to another.
 <value> can be given in decimal or hexidecimal.
 <val> can be a literal value or a register name.
 
+push <val>        push value onto the stack
+pop <dst>         pop the value on top of the stack into <dst>
+
 jmp <dst> means change pc to <dst>.
 jez <reg> <dst> means change pc to <dst> if register <reg> is 0.
 jnz <reg> <dst> means change pc to <dst> if register <reg> is not 0.
 jgz <reg> : > 0
 jlz <reg> : < 0
 
+call <dst> pushes the address of the next instruction and changes
+pc to <dst>, an address or a register.
+ret pops an address pushed by call into pc.
+
+call <fname> calls system call <fname> with the values in reg0, reg1,
+and reg2.  A value returned by the system call is put in reg0.
+When a program is loaded from tape, "call <fname>" is replaced by
+sys <num>, which calls system call number <num>.
+
+System calls:
+memcopy    copy reg2 words from address reg0 to address reg1
+memfill    store the value reg1 into reg2 words starting at address reg0
+ttywrite   print reg1 words starting at address reg0
+ttyread    read reg1 words from the keyboard into memory starting at
+           address reg0; reg0 is set to the number of words read.
+           The process waits off the CPU until the words arrive.
+sleep      wait, off the CPU, for at least reg0 cycles (instructions)
+alarm      store 1 at address reg1 after reg0 cycles, without waiting;
+           reg0 = 0 cancels the alarm.  reg0 is set to the cycles that
+           were left on the alarm it replaced, or 0
+
 end  means end the program
 
+div or mod by 0 ends the program with a divide by zero trap.
+
 Sample program: multiply values in addresses 0 and 1, leaving
 result in location 2.
 
@@ -56,15 +108,13 @@ result in location 2.
 
 
 class Monitor:
-    def __init__(self, ram):
+    def __init__(self, machine, debug=False):
         self._debug = False
-        self._ram = ram
-
-        self._os = calos.CalOS(ram)
-        # may have to become a list of cores
-        self._cpus = [ CPU(self._ram, self._os, 0) , CPU(self._ram, self._os, 1) ]
-        self._os.set_cpus(self._cpus)
-        self.set_debug(False)
+        self._machine = machine
+        self._ram = machine.get_ram()
+        self._os = machine.get_os()
+        self._cpus = machine.get_cpus()
+        self.set_debug(debug)
 
     def run(self):
         print("Monitor: enter ? to see options.")
@@ -84,11 +134,25 @@ class Monitor:
                 print("S <start> <end>: show memory from start to end")
                 print("X <addr>: execute program starting at addr")
                 print("L <addr> <tapename>: load a program from tape to bytes starting at addr")
+                print("L <tapename>: load a program from tape to wherever the OS finds room,")
+                print("   sharing its code with the processes already running it")
+                print("P [<addr>] <tapename>: like L, but page the program in on demand")
+                print("M <manifest>: load all the programs listed in a manifest (see manifest.py)")
                 print("W <start> <end> <tapename>: write bytes from start to end to tape")
+                print("   (a tapename ending in .csv or .bin is written as CSV or binary,")
+                print("    and one ending in .gz is gzip-compressed)")
                 print("R : Start up OS and execute ready queue")
+                print("K : Compact memory: move processes' memory together")
                 print("! : Toggle debugging on or off -- off at startup.")
                 continue
 
+            # A manifest's filename is used as typed: the tapes it lists
+            # are usually named in lower case too.
+            words = instr.split()
+            if len(words) == 2 and words[0].upper() == 'M':
+                self._load_manifest(words[1])
+                continue
+
             # Remove all commas, just in case, and upper-case the command
             instr = instr.replace(",", "").upper()
             
@@ -110,10 +174,19 @@ class Monitor:
             self.set_debug(not self._debug)
         elif instr.startswith("R"):
             self._os.run()
+        elif instr.startswith("K"):
+            self._os.compact_memory()
         else:
             print("Unknown command")
 
     def _one_arg_instr(self, instr):
+        if instr.startswith('L ') or instr.startswith('P '):
+            # No address given: the OS decides where the program goes.
+            try:
+                self._load_program(None, instr.split()[1], demand=instr.startswith('P '))
+            except:
+                print("Illegal format")
+            return
         try:
             arg1 = eval(instr.split()[1])
         except:
@@ -144,6 +217,14 @@ class Monitor:
                 self._load_program(startaddr, tapename)
             except:
                 print("Illegal format")
+
+        elif instr.startswith('P '):
+            try:
+                startaddr = eval(instr.split()[1])
+                tapename = instr.split()[2]
+                self._load_program(startaddr, tapename, demand=True)
+            except:
+                print("Illegal format")
         else:
             print("Unknown command")
 
@@ -166,85 +247,106 @@ class Monitor:
             cpu.set_debug(self._debug)
         self._os.set_debug(self._debug)
 
-    def _load_program(self, startaddr, tapename, procname=None):
+    def _load_program(self, startaddr, tapename, procname=None, demand=False):
         '''Load a program into memory from a stored tape (a file) starting
-        at address startaddr.  Create a PCB for the program and add to
+        at address startaddr, or, if startaddr is None, wherever the OS finds
+        room for its code and data.  Create a PCB for the program and add to
         the ready q.  Use the first part of the tapename as the procname,
         if not provided. 
+        If demand is True, nothing is copied into memory now: each page
+        of the program is copied in by the OS the first time the process
+        touches it.
         '''
         
         if procname is None:
             # Lop off .* from the end.
             procname = tapename[: tapename.find(".")]
-        pcb = None
         try:
-            with open(tapename, "r") as f:
-                pcb = calos.PCB(procname)
-                if self._debug:
-                    print("Created PCB for process {}".format(procname))
-                addr = startaddr
-                pcb.set_low_mem(addr)
-                for line in f:
-                    line = line.strip()
-                    if line == '':
-                        continue            # skip empty lines
-                    if line.startswith('#'):    
-                        continue	    # skip comment lines
-                    if line.isdigit():      # data
-                        self._ram[addr] = int(line)
-                        addr += 1
-                    elif line.startswith("__main:"):
-                        self._handle_main_label(addr, line, pcb)
-                    elif line.startswith("__data:"):
-                        self._handle_data_label(addr, line, pcb)
-                    else:   # the line is regular code: store it in ram
-                        self._ram[addr] = line
-                        addr += 1
-            print("Tape loaded from {} to {}".format(startaddr, addr - 1))
-            if self._debug:
-                print(pcb)
+            image = tape.read_tape(tapename, self._resolve_syscall)
         except FileNotFoundError:
             print("File not found")
-        if pcb is not None:
-            self._os.add_to_ready_q(pcb)
-
-    def _handle_main_label(self, addr, line, pcb):
-        """line from the file has format __main: <addr>,
-        which indicates where the entry point is.  Note: all
-        addresses in the code are logical.
-        e.g., __main: 0 means the code assumes
-        the executable lives at 0.  It might be loaded
-        into some other location, which is the value in addr.
-        """
-        if len(line.split()) != 2:
-            raise ValueError("Illegal format: __main: must be followed by entrypoint address.")
-        logical_addr = int(line.split()[1])
-        pcb.set_entry_point(logical_addr)
+            return
+        if startaddr is not None and not self._ram.is_legal_range(startaddr, len(image)):
+            print("Tape does not fit in RAM")
+            return
+
+        pcb = calos.PCB(procname)
         if self._debug:
-            print("__main found at physical location", addr, "but logical addr", logical_addr)
-
-    def _handle_data_label(self, addr, line, pcb):
-        """line from the file has format __data: <size>,
-        which indicates how many bytes are needed to store data for the program.
-        NOTE NOTE NOTE: we assume this label, if found, is immediately after the
-        code.
-        """
-        if len(line.split()) != 2:
-            raise ValueError("Illegal format: __data: must be followed by # of bytes.")
-        num_bytes = int(line.split()[1])
-        pcb.set_high_mem(addr + num_bytes)
+            print("Created PCB for process {}".format(procname))
+        if self._os.load_program(pcb, image, startaddr, demand) is None:
+            size = image.get_mem_size()
+            if size is None:
+                size = len(image)
+            if startaddr is None:
+                print("Not enough memory for tape")
+            elif not self._ram.is_legal_range(startaddr, size + calos.STACK_SIZE):
+                print("Tape and its stack do not fit in RAM")
+            else:
+                print("Memory from {} to {} is in use".format(
+                    startaddr, startaddr + size + calos.STACK_SIZE - 1))
+            return
+        startaddr = pcb.get_low_mem()
+        if self._debug and image.get_entry_point() is not None:
+            print("__main found: logical addr", image.get_entry_point())
+        # The OS put the process's stack above its code and data.
         if self._debug:
-            print("__data found at physical location", addr, "with size", num_bytes)
-            print("high memory limit set at", addr + num_bytes)
+            print("high memory limit set at", pcb.get_high_mem())
+
+        seg = pcb.get_text()
+        if demand:
+            print("Tape mapped from {} to {}".format(startaddr, startaddr + len(image) - 1))
+        elif seg is not None:
+            print("Tape loaded: code at {} to {} (shared), data from {} to {}".format(
+                seg.get_start(), seg.get_start() + seg.get_size() - 1,
+                startaddr + seg.get_size(), pcb.get_high_mem() - 1))
+        else:
+            print("Tape loaded from {} to {}".format(startaddr, startaddr + len(image) - 1))
+        if self._debug:
+            print(pcb)
+        self._os.add_to_ready_q(pcb)
+
+    def _load_manifest(self, filename):
+        '''Load all the programs listed in the manifest filename, and add
+        their processes to the ready q.'''
+        try:
+            pcbs = manifest.load_manifest(self._os, filename, self._resolve_syscall)
+        except FileNotFoundError as e:
+            print("File not found:", e.filename)
+            return
+        except OSError as e:
+            print("Cannot read {}: {}".format(e.filename, e.strerror))
+            return
+        except ValueError as e:
+            print("Manifest not loaded:", e)
+            return
+        for pcb in pcbs:
+            seg = pcb.get_text()
+            if seg is None:
+                print("Loaded {} from {} to {}".format(pcb.get_name(), pcb.get_low_mem(), pcb.get_high_mem() - 1))
+            else:
+                print("Loaded {}: code at {} (shared), data from {} to {}".format(
+                    pcb.get_name(), seg.get_start(), pcb.get_low_mem() + seg.get_size(),
+                    pcb.get_high_mem() - 1))
+            if self._debug:
+                print(pcb)
+
+    def _resolve_syscall(self, line):
+        '''Turn "call fname" into "sys <num>", so that the system call
+        does not have to be looked up by name every time it is made.'''
+        words = line.split()
+        if len(words) == 2 and words[0] == "call":
+            num = self._os.get_syscall_num(words[1])
+            if num is not None:
+                return "sys {}".format(num)
+        return line
 
     def _write_program(self, startaddr, endaddr, tapename):
         '''Write memory from startaddr to endaddr to tape (a file).'''
-        with open(tapename, "w") as f:
-            addr = startaddr
-            while addr <= endaddr:
-                f.write(str(self._ram[addr]) + "\n")
-                addr += 1
-        print("Tape written from {} to {}".format(startaddr, addr - 1))
+        if not self._ram.is_legal_range(startaddr, endaddr - startaddr + 1):
+            print("Illegal address")
+            return
+        export.export_ram(self._ram, startaddr, endaddr, tapename)
+        print("Tape written from {} to {}".format(startaddr, endaddr))
 
     def _run_program(self, addr):
         # Set the program counter and start the CPU running.
@@ -258,45 +360,52 @@ class Monitor:
         if not self._ram.is_legal_addr(curr_addr):
             print("Illegal address")
             return
+        # Collect the code, then store it in RAM all at once.
+        code = []
         while True:
-            code = input("Enter code ('.' to end) [{}]> ".format(curr_addr))
-            if code == '.':
-                return
-            self._ram[curr_addr] = code
+            line = input("Enter code ('.' to end) [{}]> ".format(curr_addr))
+            if line == '.':
+                break
+            code.append(line)
             curr_addr += 1
             if not self._ram.is_legal_addr(curr_addr):
                 print("End of RAM")
-                return
+                break
+        self._ram.write_block(int(starting_addr), code)
         
     def _poke_ram(self, starting_addr):
         curr_addr = int(starting_addr)
         if not self._ram.is_legal_addr(curr_addr):
             print("Illegal address")
             return
+        # Collect the values, then store them in RAM all at once.  Values
+        # entered before a bad value are still stored.
+        vals = []
         while True:
             data = input("Enter value (. to end) [{}]> ".format(curr_addr))
             if data == '.':
-                return
+                break
             if data[0] == "'":    # user entering string, max 4 characters.
                 end = data.find("'", 1)
                 if end == -1:
                     print("Bad string: no ending quote")
-                    return
+                    break
                 if end > MAX_CHARS_PER_ADDR:
                     end = MAX_CHARS_PER_ADDR
                 data = data[0:end] + "'"
-                self._ram[curr_addr] = data
+                vals.append(data)
             else:
                 try:
                     data = int(data)
                 except:
                     print("Bad value")
-                    return
-                self._ram[curr_addr] = data
+                    break
+                vals.append(data)
             curr_addr += 1
             if not self._ram.is_legal_addr(curr_addr):
                 print("End of RAM")
-                return
+                break
+        self._ram.write_block(int(starting_addr), vals)
 
     def _dump_ram(self, starting_addr, ending_addr):
         curr_addr = int(starting_addr)
@@ -310,17 +419,19 @@ class Monitor:
         if end_addr < curr_addr:
             print("Nothing to display")
             return
-        while curr_addr <= end_addr:
-            val = self._ram[curr_addr]
-            if isinstance(val, int):
-                print("[%04d] %d" % (curr_addr, val))
-            else:
-                print("[%04d] %s" % (curr_addr, val))
-            curr_addr += 1
+        export.dump_ram(self._ram, curr_addr, end_addr)
         
-# Main
-ram = RAM()
+# Main: python main.py [<machine config file>]
+if len(sys.argv) > 1:
+    try:
+        machine_config = config.read_config(sys.argv[1])
+    except (OSError, ValueError) as e:
+        print("Bad machine config {}: {}".format(sys.argv[1], e))
+        sys.exit(1)
+else:
+    machine_config = config.MachineConfig()
+machine = build_machine(machine_config)
 
 # Like BIOS
-monitor = Monitor(ram) 
+monitor = Monitor(machine, machine_config.get_debug())
 monitor.run()
@@ -0,0 +1,140 @@
+'''Load many programs at once, from a manifest: a file listing the tapes
+to run, one process per line, e.g.:
+
+# tapename   settings
+mult.asm     priority=1
+mult.asm     quantum=10
+fact.asm     at=500 name=fact500
+
+Each line names a tape, followed by any of these settings:
+at=<addr>        load the program at addr.  Default: wherever the OS finds
+                 room, sharing its code with the other processes running it.
+priority=<n>     the process goes ahead of those with lower priority in
+                 the ready queue.  Default: calos.DEFAULT_PRIORITY.
+quantum=<n>      how long the process runs before being interrupted.
+                 Default: calos.DEFAULT_QUANTUM.
+name=<procname>  Default: the tapename, without its extension.
+Empty lines and lines starting with # are skipped.
+
+The tapes are read in parallel, each one only once however many lines
+name it.  Then the programs are placed -- those with an address first --
+and all the processes are added to the ready queue at once, in the order
+they are listed (by priority) -- or, if any of them cannot be loaded,
+none are.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+
+import calos
+import tape
+
+# Number of tapes read at the same time.
+DEFAULT_WORKERS = 8
+
+
+class ManifestEntry:
+    '''One line of a manifest: a process to create.'''
+
+    def __init__(self, tapename, startaddr=None, priority=calos.DEFAULT_PRIORITY,
+                 quantum=calos.DEFAULT_QUANTUM, procname=None):
+        if quantum < 1:
+            raise ValueError("A quantum must be at least 1")
+        if procname is None:
+            # Lop off .* from the end.
+            procname = tapename.split(".")[0]
+        self._tapename = tapename
+        self._startaddr = startaddr
+        self._priority = priority
+        self._quantum = quantum
+        self._procname = procname
+
+    def get_tapename(self):
+        return self._tapename
+
+    def get_startaddr(self):
+        '''Return the address to load the program at, or None.'''
+        return self._startaddr
+
+    def get_priority(self):
+        return self._priority
+
+    def get_quantum(self):
+        return self._quantum
+
+    def get_procname(self):
+        return self._procname
+
+
+def read_manifest(filename):
+    '''Read the manifest filename and return its list of ManifestEntry.
+    Raises FileNotFoundError if there is no such file, and ValueError if
+    a line is bad.'''
+    entries = []
+    with open(filename, "r") as f:
+        for num, line in enumerate(f, 1):
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            try:
+                entries.append(_parse_line(line))
+            except ValueError as e:
+                raise ValueError("{}, line {}: {}".format(filename, num, e))
+    return entries
+
+
+def _parse_line(line):
+    words = line.split()
+    settings = {}
+    for word in words[1:]:
+        key, sep, value = word.partition("=")
+        if sep == '' or value == '':
+            raise ValueError("expected <setting>=<value>, not " + word)
+        if key == "name":
+            settings["procname"] = value
+        elif key in ("at", "priority", "quantum"):
+            try:
+                value = int(value)
+            except ValueError:
+                raise ValueError("{} must be a number, not {}".format(key, value))
+            settings["startaddr" if key == "at" else key] = value
+        else:
+            raise ValueError("unknown setting: " + key)
+    return ManifestEntry(words[0], **settings)
+
+
+def load_manifest(os, filename, resolve=None, workers=DEFAULT_WORKERS):
+    '''Load the programs listed in the manifest filename into os's
+    memory, and add their processes to the ready queue.  resolve is
+    passed on to tape.read_tape().  Return the list of PCBs created.
+    Raises OSError (e.g., FileNotFoundError) if the manifest or a tape
+    cannot be read, and ValueError if one is bad or a program cannot be
+    loaded.  If anything goes wrong, no process is created.'''
+    entries = read_manifest(filename)
+    tapenames = list(dict.fromkeys(entry.get_tapename() for entry in entries))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        images = dict(zip(tapenames, executor.map(
+            lambda tapename: tape.read_tape(tapename, resolve), tapenames)))
+
+    # The PCBs get pids only once all the programs are loaded.
+    pcbs = [calos.PCB(entry.get_procname(), calos.PCB.NO_PID) for entry in entries]
+    loaded = []
+    try:
+        # Programs with an address go first, so that the others cannot
+        # take their memory.
+        for entry, pcb in sorted(zip(entries, pcbs), key=lambda ep: ep[0].get_startaddr() is None):
+            pcb.set_priority(entry.get_priority())
+            pcb.set_quantum(entry.get_quantum())
+            if os.load_program(pcb, images[entry.get_tapename()], entry.get_startaddr()) is None:
+                if entry.get_startaddr() is None:
+                    raise ValueError("Not enough memory for " + entry.get_tapename())
+                raise ValueError("Memory at {} is not available for {}".format(
+                    entry.get_startaddr(), entry.get_tapename()))
+            loaded.append(pcb)
+    except Exception:
+        for pcb in loaded:
+            os.free_memory(pcb)
+        raise
+    for pcb in pcbs:
+        pcb.assign_pid()
+    os.add_procs_to_ready_q(pcbs)
+    return pcbs
@@ -0,0 +1,122 @@
+'''Keep track of which parts of RAM are given to processes.'''
+
+import bisect
+import threading
+
+
+class MemoryManager:
+    '''Manage the addresses from low up to (not including) high with a
+    free list: a list of (start, size) free blocks, sorted by address.
+    Blocks are allocated first-fit, and a freed block is merged with
+    the free blocks on either side of it, so free memory does not get
+    chopped into ever smaller pieces.
+    '''
+
+    def __init__(self, low, high):
+        self._low = low
+        self._high = high
+        self._free = [(low, high - low)] if high > low else []
+        # size of each allocated block, by start address.
+        self._allocated = {}
+        # allocate() and free() may be called from several CPU threads.
+        self._lock = threading.Lock()
+
+    def allocate(self, size):
+        '''Allocate size words.  Return the start address of the block,
+        or None if there is no free block big enough.'''
+        with self._lock:
+            for idx, (start, free_size) in enumerate(self._free):
+                if free_size >= size:
+                    self._take(idx, start, size)
+                    return start
+            return None
+
+    def allocate_at(self, start, size):
+        '''Allocate the size words starting at start.  Return False, and
+        allocate nothing, if any of them is not free or is outside the
+        managed range.'''
+        if start < self._low or start + size > self._high:
+            return False
+        with self._lock:
+            for idx, (free_start, free_size) in enumerate(self._free):
+                if free_start <= start and start + size <= free_start + free_size:
+                    self._take(idx, start, size)
+                    return True
+            return False
+
+    def free(self, start):
+        '''Free the block that starts at start.'''
+        with self._lock:
+            if start not in self._allocated:
+                return
+            size = self._allocated.pop(start)
+            idx = bisect.bisect(self._free, (start, 0))
+            # Coalesce with the following and preceding free blocks.
+            if idx < len(self._free) and self._free[idx][0] == start + size:
+                size += self._free.pop(idx)[1]
+            if idx > 0:
+                prev_start, prev_size = self._free[idx - 1]
+                if prev_start + prev_size == start:
+                    self._free[idx - 1] = (prev_start, prev_size + size)
+                    return
+            self._free.insert(idx, (start, size))
+
+    def compact(self, is_movable):
+        '''Slide the allocated blocks for which is_movable(start) is True
+        down to lower addresses, so that the free memory between blocks
+        ends up in one piece (or one piece per gap between unmovable
+        blocks).  Return the list of moves made, as (old_start, new_start,
+        size), in increasing address order: the caller must copy the
+        contents of memory in that order.'''
+        with self._lock:
+            moves = []
+            allocated = {}
+            next_free = self._low
+            for start in sorted(self._allocated):
+                size = self._allocated[start]
+                if start > next_free and is_movable(start):
+                    moves.append((start, next_free, size))
+                    start = next_free
+                allocated[start] = size
+                next_free = start + size
+            self._allocated = allocated
+            self._rebuild_free_list()
+            return moves
+
+    def get_free_words(self):
+        '''Return the total number of free words.'''
+        with self._lock:
+            return sum(size for start, size in self._free)
+
+    def get_largest_free(self):
+        '''Return the size of the largest free block.'''
+        with self._lock:
+            return max((size for start, size in self._free), default=0)
+
+    def clone(self):
+        other = MemoryManager(self._low, self._high)
+        with self._lock:
+            other._free = list(self._free)
+            other._allocated = dict(self._allocated)
+        return other
+
+    def _take(self, idx, start, size):
+        '''Allocate start to start + size from free block number idx,
+        which contains it.'''
+        free_start, free_size = self._free.pop(idx)
+        # Give back what is left over before and after the block.
+        if start + size < free_start + free_size:
+            self._free.insert(idx, (start + size, free_start + free_size - start - size))
+        if free_start < start:
+            self._free.insert(idx, (free_start, start - free_start))
+        self._allocated[start] = size
+
+    def _rebuild_free_list(self):
+        self._free = []
+        next_free = self._low
+        for start in sorted(self._allocated):
+            if start > next_free:
+                self._free.append((next_free, start - next_free))
+            next_free = start + self._allocated[start]
+        if next_free < self._high:
+            self._free.append((next_free, self._high - next_free))
@@ -0,0 +1,12 @@
+# Multiply two numbers, found in locations 4 and 5, leaving the result in
+# location 6, using mul.  Executes 4 instructions, whatever the numbers:
+# mult.asm executes 4 * (2nd number) + 6 (e.g., 42 for 7 x 9, 406 for
+# 12 x 100).
+# Note: all addresses are logical
+__main: 0
+mov *4 reg0
+mul *5 reg0
+mov reg0 6
+end
+# Need space for 3 values: 2 operands and the result.
+__data: 3
@@ -1,5 +1,10 @@
 RAM_SIZE = 1024
 
+# RAM is stored as a list of pages of this many words.  A cloned RAM shares
+# its pages with the original until one of them writes to a page, at which
+# point only that page is copied (copy-on-write).
+PAGE_SIZE = 64
+
 
 class RAM:
     '''A representation of RAM. You can access it by using indexing operators: [].
@@ -8,33 +13,124 @@ class RAM:
     '''
     def __init__(self, size=RAM_SIZE):
         self._minAddr = 0
-        self._maxAddr = RAM_SIZE - 1
-        self._memory = []   # a list of values.  Could be #s or instructions.
-        for i in range(size):
-            self._memory.append(0)
+        self._maxAddr = size - 1
+        # a list of pages, each a list of values.  Could be #s or instructions.
+        num_pages = (size + PAGE_SIZE - 1) // PAGE_SIZE
+        self._pages = [[0] * PAGE_SIZE for i in range(num_pages)]
+        # _owned[p] is False if page p may be shared with a clone, so
+        # it must be copied before it is written.
+        self._owned = [True] * num_pages
 
     def __getitem__(self, addr):
         '''called when a ram object is indexed/subscripted: ram[3], e.g.'''
         assert self.is_legal_addr(addr)
-        return self._memory[addr]
+        return self._pages[addr // PAGE_SIZE][addr % PAGE_SIZE]
 
     def __setitem__(self, addr, val):
         '''called when a ram object is indexed/subscripted: ram[3] = 44, e.g.'''
         assert self.is_legal_addr(addr)
-        self._memory[addr] = val
+        page = addr // PAGE_SIZE
+        if not self._owned[page]:
+            self._pages[page] = list(self._pages[page])
+            self._owned[page] = True
+        self._pages[page][addr % PAGE_SIZE] = val
+
+    def get_size(self):
+        return self._maxAddr + 1
 
     def is_legal_addr(self, addr):
         return self._minAddr <= addr <= self._maxAddr
 
+    def is_legal_range(self, addr, count):
+        '''Return True if the count words starting at addr are all legal.'''
+        if count == 0:
+            return True
+        return count > 0 and self.is_legal_addr(addr) and self.is_legal_addr(addr + count - 1)
+
+    def read_block(self, addr, count):
+        '''Return a list of the count words starting at addr.'''
+        assert self.is_legal_range(addr, count)
+        vals = []
+        end = addr + count
+        while addr < end:
+            page, offset = divmod(addr, PAGE_SIZE)
+            n = min(PAGE_SIZE - offset, end - addr)
+            vals.extend(self._pages[page][offset:offset + n])
+            addr += n
+        return vals
+
+    def write_block(self, addr, vals):
+        '''Store the values in the list vals into consecutive words,
+        starting at addr.'''
+        assert self.is_legal_range(addr, len(vals))
+        i = 0
+        while i < len(vals):
+            page, offset = divmod(addr + i, PAGE_SIZE)
+            n = min(PAGE_SIZE - offset, len(vals) - i)
+            if n == PAGE_SIZE:
+                # Replacing the whole page: no need to copy a shared one first.
+                self._pages[page] = list(vals[i:i + n])
+                self._owned[page] = True
+            else:
+                self._own_page(page)
+                self._pages[page][offset:offset + n] = vals[i:i + n]
+            i += n
+
+    def copy_block(self, src, dst, count):
+        '''Copy count words from src to dst.  The areas may overlap.'''
+        self.write_block(dst, self.read_block(src, count))
+
+    def fill_block(self, addr, val, count):
+        '''Store val into the count words starting at addr.'''
+        self.write_block(addr, [val] * count)
+
+    def _own_page(self, page):
+        '''Make sure page is not shared with a clone, copying it if
+        necessary, so that it can be written.'''
+        if not self._owned[page]:
+            self._pages[page] = list(self._pages[page])
+            self._owned[page] = True
+
+    def clone(self):
+        '''Return a copy of this RAM.  No words are copied now: both RAMs
+        share all pages, and a page is copied by whichever RAM writes
+        to it first.'''
+        other = RAM.__new__(RAM)
+        other._minAddr = self._minAddr
+        other._maxAddr = self._maxAddr
+        other._pages = list(self._pages)
+        other._owned = [False] * len(self._pages)
+        self._owned = [False] * len(self._pages)
+        return other
+
 
 class MMU:
     """Memory management unit: translate logical addresses to
-    physical addresses and check memory limits."""
+    physical addresses and check memory limits.
+
+    A process's memory may start with a shared text segment: the
+    logical addresses below the text size are the process's code,
+    which is at physical address text base, and may be used by other
+    processes at the same time.  It is read-only: writing to it calls
+    the protection handler instead.  The other logical addresses are
+    relocated by the relocation register, as usual."""
+
+    __slots__ = ('_ram', '_reloc_register', '_limit_register', '_page_table',
+                 '_fault_handler', '_text_base', '_text_size', '_protection_handler')
 
     def __init__(self, ram):
         self._ram = ram
         self._reloc_register = 0
         self._limit_register = 0
+        # For demand paging: a list saying whether each logical page is
+        # present in memory, or None if everything is present.  Touching a
+        # page that is not present calls _fault_handler(page) first.
+        self._page_table = None
+        self._fault_handler = None
+        # The shared text segment.  A size of 0 means there is none.
+        self._text_base = 0
+        self._text_size = 0
+        self._protection_handler = None
 
     def set_reloc_register(self, base):
         self._reloc_register = base
@@ -42,21 +138,109 @@ class MMU:
     def set_limit_register(self, limit):
         self._limit_register = limit
 
+    def set_text_registers(self, base, size):
+        self._text_base = base
+        self._text_size = size
+
+    def set_page_table(self, page_table):
+        self._page_table = page_table
+
+    def set_fault_handler(self, handler):
+        self._fault_handler = handler
+
+    def set_protection_handler(self, handler):
+        """handler(addr) is called, instead of writing, when the logical
+        address addr in the text segment is written to."""
+        self._protection_handler = handler
+
+    def get_reloc_register(self):
+        return self._reloc_register
+
+    def get_limit_register(self):
+        return self._limit_register
+
+    def get_text_registers(self):
+        return self._text_base, self._text_size
+
     def get_val(self, addr):
         self._check_addr(addr)
+        if 0 <= addr < self._text_size:
+            return self._ram[addr + self._text_base]
         return self._ram[addr + self._reloc_register]
 
     def set_val(self, addr, val):
         self._check_addr(addr)
+        if self._in_text(addr, 1):
+            return
         self._ram[addr + self._reloc_register] = val
 
+    def read_block(self, addr, count):
+        self._check_range(addr, count)
+        if 0 <= addr < self._text_size:
+            # The part in the text segment, then the rest.
+            n = min(count, self._text_size - addr)
+            return (self._ram.read_block(addr + self._text_base, n) +
+                    self._ram.read_block(addr + n + self._reloc_register, count - n))
+        return self._ram.read_block(addr + self._reloc_register, count)
+
+    def write_block(self, addr, vals):
+        self._check_range(addr, len(vals))
+        if self._in_text(addr, len(vals)):
+            return
+        self._ram.write_block(addr + self._reloc_register, vals)
+
+    def copy_block(self, src, dst, count):
+        self._check_range(src, count)
+        self._check_range(dst, count)
+        if self._in_text(dst, count):
+            return
+        if 0 <= src < self._text_size:
+            self._ram.write_block(dst + self._reloc_register, self.read_block(src, count))
+        else:
+            self._ram.copy_block(src + self._reloc_register, dst + self._reloc_register, count)
+
+    def fill_block(self, addr, val, count):
+        self._check_range(addr, count)
+        if self._in_text(addr, count):
+            return
+        self._ram.fill_block(addr + self._reloc_register, val, count)
+
+    def _in_text(self, addr, count):
+        '''Return True, after calling the protection handler, if any of
+        the count words from addr are in the text segment.'''
+        if count > 0 and addr < self._text_size and addr + count > 0:
+            print("BAD ADDRESS!: write to code")
+            if self._protection_handler is not None:
+                self._protection_handler(max(addr, 0))
+            return True
+        return False
+
     def _check_addr(self, addr):
         if addr >= self._limit_register:
             # generate trap (software interrupt)
             print("BAD ADDRESS!: too high")
+        if self._page_table is not None:
+            self._check_page(addr // PAGE_SIZE)
+
+    def _check_range(self, addr, count):
+        '''Check the count words starting at addr with one comparison.'''
+        if count > 0:
+            if addr + count > self._limit_register:
+                print("BAD ADDRESS!: too high")
+            if self._page_table is not None:
+                for page in range(addr // PAGE_SIZE, (addr + count - 1) // PAGE_SIZE + 1):
+                    self._check_page(page)
+
+    def _check_page(self, page):
+        '''Page fault if page is not present.  Pages past the end of the
+        page table are not paged.'''
+        if 0 <= page < len(self._page_table) and not self._page_table[page]:
+            self._fault_handler(page)
 
     def get_translated_addr(self, addr):
         """Return the physical address for the given logical address"""
+        if 0 <= addr < self._text_size:
+            return addr + self._text_base
         return addr + self._reloc_register
 
 
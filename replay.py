@@ -0,0 +1,160 @@
+'''Record the nondeterministic events of a run, and replay them exactly.
+
+Running with debugging on is slow, and the printing changes how the CPU
+threads interleave, so bugs can disappear.  Instead, record a run at
+full speed: only the events that could come out differently next time
+are logged, in the order the CPUs entered the kernel.  These are:
+o timer interrupts, as the cycle (instruction count) of the CPU at
+  which each was handled,
+o software traps (a process ending), likewise,
+o processes starting to wait for the tty, likewise, and
+o waiting processes being woken up, with the words the tty read for them.
+Then replay the log, as slowly and with as much debugging as you like.
+The replay runs all CPUs in one thread, stepping each CPU up to its next
+event in the logged order, so the ready queue sees the same sequence
+of changes as in the recorded run.
+
+NOTE: the order of memory accesses by processes running at the same
+time on different CPUs is not recorded: processes that share memory may
+not replay exactly.  Likewise, an alarm set while another CPU is taking
+a timer interrupt may go off one timer interrupt earlier or later.
+
+Typical use:
+    recorder, snapshot = replay.record(machine)
+    machine.run()
+    recorder.save("run.log")
+    ...
+    replayer = replay.Replayer(snapshot, replay.load_events("run.log"))
+    replayer.run()
+'''
+
+import json
+import threading
+
+import calos
+import cpu as cpumodule
+
+# Kinds of events.
+TIMER, TRAP, BLOCK, IO = "timer", "trap", "block", "io"
+
+
+class Recorder:
+    '''A log of events, each a tuple (kind, cpu number, cycle) -- plus the
+    pid of the process woken up and the words read, for IO events -- in
+    the order they happened.'''
+
+    def __init__(self):
+        self._events = []
+        # CPU threads record events at the same time.
+        self._lock = threading.Lock()
+
+    def record_timer(self, cpu_num, cycle):
+        self._record((TIMER, cpu_num, cycle))
+
+    def record_trap(self, cpu_num, cycle):
+        self._record((TRAP, cpu_num, cycle))
+
+    def record_block(self, cpu_num, cycle):
+        self._record((BLOCK, cpu_num, cycle))
+
+    def record_io(self, cpu_num, cycle, pid, words):
+        self._record((IO, cpu_num, cycle, pid, list(words)))
+
+    def get_events(self):
+        with self._lock:
+            return list(self._events)
+
+    def save(self, filename):
+        '''Write the events to filename, one JSON list per line.'''
+        with open(filename, "w") as f:
+            f.write("".join(json.dumps(event) + "\n" for event in self.get_events()))
+
+    def _record(self, event):
+        with self._lock:
+            self._events.append(event)
+
+
+def load_events(filename):
+    '''Return the list of events saved by Recorder.save().'''
+    with open(filename, "r") as f:
+        return [tuple(json.loads(line)) for line in f if line.strip() != '']
+
+
+def record(machine):
+    '''Start recording the events of machine's runs.  Return the
+    Recorder and a clone of machine as it is now, to replay on.'''
+    snapshot = machine.clone()
+    recorder = Recorder()
+    machine.get_os().set_recorder(recorder)
+    return recorder, snapshot
+
+
+class Replayer:
+    '''Replay a list of events on a machine that is in the same state as
+    the recorded machine was when the recording started.'''
+
+    def __init__(self, machine, events):
+        self._machine = machine
+        self._events = events
+        # The tty requests made during the replay, by pid.
+        self._requests = {}
+
+    def request_read(self, request, done):
+        '''The replayer is the tty: the words come from the IO events.'''
+        self._requests[request.get_pcb().get_pid()] = request
+
+    def run(self):
+        '''Run the machine, reproducing the recorded events.  Raises
+        RuntimeError if the run does not go the way the recorded one did.'''
+        os = self._machine.get_os()
+        cpus = self._machine.get_cpus()
+        clock_modes = [cpu.get_clock_mode() for cpu in cpus]
+        for cpu in cpus:
+            cpu.set_clock_mode(cpumodule.CLOCK_EXTERNAL)
+        os.set_replayer(self)
+        try:
+            started = os.start_cpus()
+            for event in self._events:
+                kind, cpu_num, cycle = event[0], event[1], event[2]
+                cpu = cpus[cpu_num]
+                if kind == TIMER:
+                    self._interrupt(cpu, cycle, cpumodule.TIMER_DEV_ID)
+                elif kind == TRAP or kind == BLOCK:
+                    self._run_to(cpu, cycle)
+                elif kind == IO:
+                    pid, words = event[3], event[4]
+                    if pid not in self._requests:
+                        raise RuntimeError("Replay diverged: process {} did not ask for input".format(pid))
+                    request = self._requests.pop(pid)
+                    request.set_words(words)
+                    os.complete_io(request)
+                    self._interrupt(cpu, cycle, cpumodule.TTY_DEV_ID)
+        finally:
+            os.set_replayer(None)
+            for cpu, clock_mode in zip(cpus, clock_modes):
+                cpu.set_clock_mode(clock_mode)
+
+        for cpu in started:
+            if not cpu.is_stopped():
+                raise RuntimeError("Replay diverged: CPU {} is still running".format(cpu.get_num()))
+            if os.get_current_proc(cpu.get_num()) is not None:
+                os.get_current_proc(cpu.get_num()).set_state(calos.PCB.DONE)
+
+    def _interrupt(self, cpu, cycle, dev_id):
+        '''Handle an interrupt from device dev_id on cpu at cycle.'''
+        if cpu.get_cycles() < cycle:
+            self._run_to(cpu, cycle - 1)
+            cpu.raise_interrupt(dev_id)
+            cpu.step()
+        else:
+            # Handled in the same step as an earlier event.
+            cpu.raise_interrupt(dev_id)
+            cpu.service_interrupts()
+
+    def _run_to(self, cpu, cycle):
+        '''Step cpu until it has executed cycle instructions.'''
+        while cpu.get_cycles() < cycle:
+            if cpu.is_stopped():
+                raise RuntimeError("Replay diverged: CPU {} stopped at cycle {}, before {}".
+                                   format(cpu.get_num(), cpu.get_cycles(), cycle))
+            cpu.step()
@@ -0,0 +1,80 @@
+'''Read programs from tapes (files).
+
+A tape holds one word per line: code, or data values.  Empty lines and
+lines starting with # are skipped.  Two labels may also appear:
+__main: <addr>   the logical address of the entry point.
+__data: <size>   the number of words of data the program needs.  We
+                 assume this label, if found, is immediately after the code.
+'''
+
+
+class TapeImage:
+    '''The contents of a tape: its words, in the order they are loaded
+    into memory, and the values of its labels.'''
+
+    def __init__(self, name, words, entry_point=None, mem_size=None):
+        self._name = name
+        self._words = words
+        self._entry_point = entry_point
+        self._mem_size = mem_size
+
+    def get_name(self):
+        return self._name
+
+    def get_words(self):
+        return self._words
+
+    def get_entry_point(self):
+        '''Return the logical address given by __main:, or None.'''
+        return self._entry_point
+
+    def get_code_size(self):
+        '''Return the number of words at the start of the tape that are
+        code: the words up to the first data value.'''
+        for idx, word in enumerate(self._words):
+            if isinstance(word, int):
+                return idx
+        return len(self._words)
+
+    def get_mem_size(self):
+        '''Return the number of words of memory the program needs, code
+        plus data, or None if the tape has no __data: label.'''
+        return self._mem_size
+
+    def __len__(self):
+        return len(self._words)
+
+
+def read_tape(tapename, resolve=None):
+    '''Read the tape tapename and return its TapeImage.  If resolve is
+    given, each line of code is replaced by resolve(line).  Raises
+    FileNotFoundError if there is no such tape, and ValueError if a
+    label is badly formatted.'''
+    words = []
+    entry_point = None
+    mem_size = None
+    with open(tapename, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line == '':
+                continue            # skip empty lines
+            if line.startswith('#'):
+                continue            # skip comment lines
+            if line.isdigit():      # data
+                words.append(int(line))
+            elif line.startswith("__main:"):
+                entry_point = _label_value(line, "__main: must be followed by entrypoint address.")
+            elif line.startswith("__data:"):
+                num_words = _label_value(line, "__data: must be followed by # of bytes.")
+                mem_size = len(words) + num_words
+            elif resolve is not None:
+                words.append(resolve(line))
+            else:
+                words.append(line)
+    return TapeImage(tapename, words, entry_point, mem_size)
+
+
+def _label_value(line, msg):
+    if len(line.split()) != 2:
+        raise ValueError("Illegal format: " + msg)
+    return int(line.split()[1])
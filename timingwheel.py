@@ -0,0 +1,159 @@
+'''A hierarchical timing wheel: a set of timers that go off at given
+ticks, where setting, cancelling and running out a timer cost O(1),
+however many timers are set.
+
+Level 0 is a wheel of SLOTS slots, one per tick: a timer that goes off
+within the next SLOTS ticks is put in the slot for its tick.  Each slot of
+level 1 covers SLOTS ticks, each slot of level 2 SLOTS ** 2 ticks, and so
+on.  When the ticks of a slot of a higher level come round, its timers
+are moved ("cascaded") down to the levels below, which spreads them out
+over slots of finer resolution.  Timers further away than all the levels
+cover wait in an overflow list, which is looked at once per turn of the
+top level.
+'''
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+LEVELS = 4
+
+
+class Timer:
+    '''A timer set with TimingWheel.schedule().'''
+
+    __slots__ = ('_deadline', '_item', '_cancelled')
+
+    def __init__(self, deadline, item):
+        self._deadline = deadline
+        self._item = item
+        self._cancelled = False
+
+    def get_deadline(self):
+        return self._deadline
+
+    def get_item(self):
+        return self._item
+
+    def is_cancelled(self):
+        return self._cancelled
+
+
+class TimingWheel:
+
+    def __init__(self, now=0, slot_bits=SLOT_BITS, levels=LEVELS):
+        self._bits = slot_bits
+        self._mask = (1 << slot_bits) - 1
+        self._levels = levels
+        self._wheels = [[[] for _ in range(1 << slot_bits)] for _ in range(levels)]
+        self._overflow = []
+        # Timers set for a tick that had already gone by.
+        self._late = []
+        self._now = now
+        # Number of timers set and not yet gone off or cancelled.
+        self._count = 0
+
+    def get_time(self):
+        '''Return the current tick.'''
+        return self._now
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, deadline, item):
+        '''Set a timer that goes off at tick deadline, returning item from
+        advance().  Return the Timer, which can be passed to cancel().'''
+        timer = Timer(deadline, item)
+        if deadline <= self._now:
+            self._late.append(timer)
+        else:
+            self._insert(timer)
+        self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        '''Stop timer from going off.  The timer stays in its slot until
+        its tick comes, but is skipped then.'''
+        if not timer._cancelled:
+            timer._cancelled = True
+            self._count -= 1
+
+    def advance(self, now):
+        '''Move the current tick forward to now.  Return the items of the
+        timers that went off, in the order of their deadlines.'''
+        items = []
+        late, self._late = self._late, []
+        self._go_off(late, items)
+        while self._now < now:
+            if self._count == 0:
+                # Nothing else is set: skip the ticks in between.  The
+                # slots hold only cancelled timers, if anything, so it
+                # does not matter where the wheels are.
+                self._now = now
+                break
+            self._tick(items)
+        return items
+
+    def clone(self, map_item=None):
+        '''Return a copy of this wheel with the same timers set.  If
+        map_item is given, the copy's timers hold map_item(item).'''
+        other = TimingWheel(self._now, self._bits, self._levels)
+        for timer in self.get_timers():
+            item = timer._item if map_item is None else map_item(timer._item)
+            other.schedule(timer._deadline, item)
+        return other
+
+    def get_timers(self):
+        '''Yield all the timers that are set.'''
+        lists = [self._late, self._overflow]
+        for wheel in self._wheels:
+            lists.extend(wheel)
+        for timers in lists:
+            for timer in timers:
+                if not timer._cancelled:
+                    yield timer
+
+    def _insert(self, timer):
+        deadline = timer._deadline
+        # Put the timer in the lowest level in which the deadline and now
+        # are in the same turn of the wheel.
+        for level in range(self._levels):
+            shift = self._bits * (level + 1)
+            if deadline >> shift == self._now >> shift:
+                slot = (deadline >> (self._bits * level)) & self._mask
+                self._wheels[level][slot].append(timer)
+                return
+        self._overflow.append(timer)
+
+    def _tick(self, items):
+        '''Move forward one tick, and add the items of the timers that go
+        off to items.'''
+        self._now += 1
+        now = self._now
+        # Find the levels that just finished a turn of the level below,
+        # and cascade their current slot, top level first.
+        top = 0
+        while top < self._levels and now & ((1 << (self._bits * (top + 1))) - 1) == 0:
+            top += 1
+        if top == self._levels:
+            overflow, self._overflow = self._overflow, []
+            for timer in overflow:
+                self._insert(timer)
+            top -= 1
+        for level in range(top, 0, -1):
+            slot = (now >> (self._bits * level)) & self._mask
+            timers = self._wheels[level][slot]
+            self._wheels[level][slot] = []
+            for timer in timers:
+                if not timer._cancelled:
+                    self._insert(timer)
+        slot = now & self._mask
+        if self._wheels[0][slot]:
+            timers = self._wheels[0][slot]
+            self._wheels[0][slot] = []
+            self._go_off(timers, items)
+
+    def _go_off(self, timers, items):
+        for timer in timers:
+            if not timer._cancelled:
+                timer._cancelled = True   # gone off: cannot be cancelled now.
+                self._count -= 1
+                items.append(timer._item)